@@ -0,0 +1,239 @@
+"""Offline benchmarks for loading, retrieval, prompt packing and formatting.
+
+Builds synthetic rules_df-shaped stores in a temporary directory and runs the real AI
+extension code against a stubbed OpenAI backend, so no network or API key is needed.
+
+    python -m benchmarks.retrieval --sizes 1000 10000 100000 --json results.json
+
+If the tiktoken encoding has never been downloaded, tokens are estimated at four
+characters each and the results say so.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+import types
+
+import numpy as np
+
+from momnisaur import knowledge
+from momnisaur.cache import EmbeddingCache
+from momnisaur.extensions import AI as ai_module
+from momnisaur.extensions.AI import AI
+
+SOURCES: list[str] = ["faq", "rules", "corrections", "actions"]
+# The share of the corpus each source gets.
+SOURCE_WEIGHTS: list[float] = [0.2, 0.6, 0.05, 0.15]
+
+VOCABULARY: list[str] = (
+    "the a hero enemy target action attack range speed effect round turn ally each "
+    "roll dice damage heal move space adjacent line sight until end start gain lose "
+    "card deck hand draw discard token trait class tier storyteller encounter"
+).split() + [key.strip() for key in ai_module.KEYWORDS]
+
+
+class ApproximateEncoding:
+    """Stands in for an uncached tiktoken encoding, at four characters a token."""
+
+    name = "approximate"
+
+    def encode(self, text: str) -> range:
+        return range(len(text) // 4 + 1)
+
+
+class StubBackend:
+    """Answers embedding and chat requests locally, optionally after a fixed delay."""
+
+    def __init__(self, dim: int, latency: float = 0.0):
+        self.dim = dim
+        self.latency = latency
+        self.active = 0
+
+    def vector(self, text: str) -> list[float]:
+        seed = int.from_bytes(
+            hashlib.sha256(text.encode("utf8")).digest()[:8], "little"
+        )
+        return (
+            np.random.default_rng(seed).standard_normal(self.dim, np.float32).tolist()
+        )
+
+    async def embed(self, priority: int = 0, **kwargs):
+        await asyncio.sleep(self.latency)
+        inputs = kwargs["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        return {
+            "data": [
+                {"index": i, "embedding": self.vector(text)}
+                for i, text in enumerate(inputs)
+            ]
+        }
+
+    async def chat(self, priority: int = 0, **kwargs):
+        await asyncio.sleep(self.latency)
+        message = types.SimpleNamespace(content=sentence(random.Random(0), 60))
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+    def queue_depth(self) -> int:
+        return 0
+
+
+class Harness:
+    """Just enough of the extension to run its knowledge base methods without a bot."""
+
+    load_partition = AI.load_partition
+    swap_partitions = AI.swap_partitions
+    update_rules_df = AI.update_rules_df
+
+    def __init__(self):
+        self.bot = types.SimpleNamespace(rules_df=None)
+        self.knowledge = knowledge.KnowledgeBase()
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def build_corpus(directory: str, size: int, dim: int, seed: int) -> dict[str, str]:
+    """Write size synthetic rows split across the sources, returning their prefixes."""
+    rng = random.Random(seed)
+    vectors = np.random.default_rng(seed)
+    prefixes = {}
+    remaining = size
+    for i, (source, weight) in enumerate(zip(SOURCES, SOURCE_WEIGHTS)):
+        count = remaining if i == len(SOURCES) - 1 else int(size * weight)
+        remaining -= count
+        texts = [sentence(rng, rng.randint(20, 200)) for _ in range(count)]
+        rows = AI.make_rows(texts)
+        embeddings = vectors.standard_normal((count, dim), np.float32)
+        prefixes[source] = os.path.join(directory, source)
+        knowledge.save_store(prefixes[source], rows, embeddings)
+    return prefixes
+
+
+def summarize(name: str, size: int, timings: list[float], peak: int) -> dict:
+    timings = sorted(timings)
+    return {
+        "benchmark": name,
+        "rows": size,
+        "runs": len(timings),
+        "ops_per_second": len(timings) / sum(timings) if sum(timings) else float("inf"),
+        "p50_ms": statistics.median(timings) * 1000,
+        "p99_ms": timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+        "peak_mb": peak / 2**20,
+    }
+
+
+async def measure(name: str, size: int, runs: int, fn) -> dict:
+    """Time runs awaits of fn(i), tracking the peak memory allocated while they run."""
+    timings = []
+    tracemalloc.start()
+    try:
+        for i in range(runs):
+            start = time.perf_counter()
+            await fn(i)
+            timings.append(time.perf_counter() - start)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return summarize(name, size, timings, peak)
+
+
+async def run_size(size: int, args) -> list[dict]:
+    rng = random.Random(args.seed)
+    queries = [sentence(rng, rng.randint(5, 25)) for _ in range(args.queries)]
+    replies = [sentence(rng, rng.randint(50, 300)) for _ in range(args.queries)]
+    formatter = AI.build_formatter({name: "<:stat:1>" for name in ai_module.STAT_EMOJI})
+
+    with tempfile.TemporaryDirectory() as directory:
+        ai_module.SAVE_PATHS = build_corpus(directory, size, args.dim, args.seed)
+        harness = Harness()
+
+        async def load(i):
+            harness.update_rules_df()
+
+        results = [await measure("update_rules_df", size, args.loads, load)]
+        df = harness.bot.rules_df
+
+        async def search(i):
+            await AI.strings_ranked_by_relatedness(queries[i], df, top_n=100)
+
+        async def pack(i):
+            await AI.query_message(
+                queries[i], df, model=ai_module.CHAT_MODEL, token_budget=1024
+            )
+
+        async def format_text(i):
+            formatter.format(replies[i])
+
+        results.append(
+            await measure("strings_ranked_by_relatedness", size, args.queries, search)
+        )
+        results.append(await measure("query_message", size, args.queries, pack))
+        results.append(await measure("format_text", size, args.queries, format_text))
+        return results
+
+
+def use_stubs(args) -> str:
+    """Point the extension at the stub backend, returning the tokenizer in use."""
+    backend = StubBackend(args.dim, args.latency)
+    ai_module.OPENAI = backend
+    # A cache that keeps nothing, so every query pays for its embedding.
+    ai_module.QUERY_EMBEDDINGS = EmbeddingCache(maxsize=0)
+    try:
+        return AI.encoding().name
+    except Exception as e:
+        print(f"tiktoken encoding unavailable ({type(e).__name__}), estimating tokens")
+        AI.encoding = staticmethod(
+            lambda model=ai_module.CHAT_MODEL: ApproximateEncoding()
+        )
+        return ApproximateEncoding.name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 50_000])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--loads", type=int, default=3)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds each stubbed request takes"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    tokenizer = use_stubs(args)
+    results = []
+    for size in args.sizes:
+        results += asyncio.run(run_size(size, args))
+
+    print(f"\ndim={args.dim} tokenizer={tokenizer}")
+    print(
+        f"{'benchmark':<30} {'rows':>8} {'ops/s':>10} {'p50 ms':>9} "
+        f"{'p99 ms':>9} {'peak MB':>9}"
+    )
+    for r in results:
+        print(
+            f"{r['benchmark']:<30} {r['rows']:>8} {r['ops_per_second']:>10.1f} "
+            f"{r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['peak_mb']:>9.1f}"
+        )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf8") as file:
+            json.dump(
+                {"dim": args.dim, "tokenizer": tokenizer, "results": results},
+                file,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import time
 import logging
 
 from dotenv import load_dotenv
@@ -29,7 +30,11 @@ async def on_ready():
     print(f"This bot is owned by {bot.owner}")
 
 
-# bot.load_extension("interactions.ext.jurigged")
-bot.load_extension("momnisaur.extensions.AI")
-bot.load_extension("momnisaur.extensions.dice")
-bot.start(DISCORD_KEY)
+# Dice rolls run in worker processes, which re-import this module when they are spawned.
+if __name__ == "__main__":
+    # Startup timings in the AI extension are measured from here.
+    bot.started = time.perf_counter()
+    # bot.load_extension("interactions.ext.jurigged")
+    bot.load_extension("momnisaur.extensions.AI")
+    bot.load_extension("momnisaur.extensions.dice")
+    bot.start(DISCORD_KEY)
@@ -0,0 +1,183 @@
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from momnisaur.knowledge import normalize
+from momnisaur.storage import atomic_write, load_npz
+
+WHITESPACE: re.Pattern = re.compile(r"\s+")
+
+
+def normalize_key(text: str) -> str:
+    """Collapse whitespace and case so trivially different queries share an entry."""
+    return WHITESPACE.sub(" ", text).strip().casefold()
+
+
+class EmbeddingCache:
+    """Bounded LRU cache of query embeddings whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 24 * 60 * 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, np.ndarray]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, text: str) -> np.ndarray | None:
+        key = normalize_key(text)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.time() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def peek(self, text: str) -> np.ndarray | None:
+        """Like get, but without counting the lookup or refreshing the entry."""
+        entry = self._entries.get(normalize_key(text))
+        if entry is None or time.time() - entry[0] >= self.ttl:
+            return None
+        return entry[1]
+
+    def put(self, text: str, embedding, created: float | None = None):
+        key = normalize_key(text)
+        self._entries[key] = (
+            time.time() if created is None else created,
+            np.asarray(embedding, dtype=np.float32),
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0
+        return (
+            f"{len(self)}/{self.maxsize} entries, {self.hits} hits, "
+            f"{self.misses} misses ({rate:.0%} hit rate)"
+        )
+
+    def save(self, path: str):
+        """Write the live entries to an .npz file so a restart does not start cold."""
+        keys = list(self._entries)
+        with atomic_write(path, "wb") as file:
+            np.savez(
+                file,
+                keys=np.array(keys, dtype=str),
+                created=np.array([self._entries[k][0] for k in keys], dtype=np.float64),
+                embeddings=np.array(
+                    [self._entries[k][1] for k in keys], dtype=np.float32
+                ),
+            )
+
+    def load(self, path: str):
+        """Restore entries saved by save, skipping any that have already expired.
+
+        An unreadable file is treated as an empty cache.
+        """
+        saved = load_npz(path, "keys", "created", "embeddings")
+        if saved is None:
+            return
+        now = time.time()
+        for key, entry_created, embedding in zip(
+            saved["keys"], saved["created"], saved["embeddings"]
+        ):
+            if now - entry_created < self.ttl:
+                self.put(str(key), embedding, created=float(entry_created))
+
+
+class SemanticCache:
+    """Answers keyed by query embedding, served to any new query similar enough to one.
+
+    Each entry remembers which knowledge base sources its context came from and the
+    relatedness of the weakest row in that context, so it can be dropped when those
+    sources change or when a new row would have ranked into it.
+    """
+
+    def __init__(
+        self, threshold: float = 0.97, maxsize: int = 512, ttl: float = 24 * 60 * 60
+    ):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: list[dict] = []
+        self._matrix: np.ndarray | None = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _unit(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _queries(self) -> np.ndarray:
+        if self._matrix is None:
+            self._matrix = np.array(
+                [e["query"] for e in self._entries], dtype=np.float32
+            )
+        return self._matrix
+
+    def _keep(self, keep: list[bool]):
+        self._entries = [e for e, k in zip(self._entries, keep) if k]
+        self._matrix = None
+
+    def get(self, embedding) -> str | None:
+        if self._entries:
+            now = time.time()
+            keep = [now - e["created"] < self.ttl for e in self._entries]
+            if not all(keep):
+                self._keep(keep)
+        if self._entries:
+            scores = self._queries() @ self._unit(embedding)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                self.hits += 1
+                return self._entries[best]["answer"]
+        self.misses += 1
+        return None
+
+    def put(self, embedding, answer: str, sources: set[str], floor: float = -1.0):
+        self._entries.append(
+            {
+                "query": self._unit(embedding),
+                "answer": answer,
+                "sources": set(sources),
+                "floor": floor,
+                "created": time.time(),
+            }
+        )
+        self._entries = self._entries[-self.maxsize :]
+        self._matrix = None
+
+    def invalidate(self, sources=(), added=None):
+        """Drop answers built from sources, or that a row in added would rank into."""
+        if not self._entries:
+            return
+        keep = [not (e["sources"] & set(sources)) for e in self._entries]
+        if added is not None and len(added):
+            best = (normalize(added) @ self._queries().T).max(axis=0)
+            keep = [k and b <= e["floor"] for k, b, e in zip(keep, best, self._entries)]
+        dropped = len(keep) - sum(keep)
+        if dropped:
+            print(f"Dropped {dropped} cached answers")
+            self._keep(keep)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0
+        return (
+            f"{len(self)}/{self.maxsize} answers, {self.hits} hits, "
+            f"{self.misses} misses ({rate:.0%} hit rate)"
+        )
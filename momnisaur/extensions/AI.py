@@ -1,35 +1,69 @@
-import ast
 import os
 import random
 import re
+import time
+import asyncio
+import threading
 import aiohttp
-import openai
-import pandas as pd
-import tiktoken
-import json
+import functools
+import numpy as np
+from typing import TYPE_CHECKING
 
 from interactions import (
     Extension,
+    Task,
+    IntervalTrigger,
     slash_command,
     SlashContext,
     listen,
     check,
     has_role,
+    is_owner,
     message_context_menu,
     ContextMenuContext,
     Modal,
     ParagraphText,
     MemberFlags,
 )
-from interactions.api.events import MessageCreate, MemberUpdate, MemberAdd
+from interactions.api.events import (
+    MessageCreate,
+    MessageUpdate,
+    MessageDelete,
+    MemberUpdate,
+    MemberAdd,
+)
+from interactions.client.errors import HTTPException
 from interactions.ext.paginators import Paginator
-from scipy import spatial
 
-EMBERWIND_KEY = os.getenv("EMBERWIND_KEY")
-EMBERWIND_EMAIL = os.getenv("EMBERWIND_EMAIL")
-EMBERWIND_PASSWORD = os.getenv("EMBERWIND_PASSWORD")
-openai.api_key = os.getenv("OPENAI_KEY")
-openai.organization = os.getenv("OPENAI_ORG")
+from momnisaur import ingest
+from momnisaur.cache import EmbeddingCache, SemanticCache
+from momnisaur.formatting import KeywordFormatter
+from momnisaur.history import ChannelHistory
+from momnisaur.jokes import JokePool
+from momnisaur.lexical import fuse
+from momnisaur.metrics import Metrics
+from momnisaur.onboarding import PendingMembers
+from momnisaur.scheduler import OpenAIScheduler, INTERACTIVE, BACKGROUND, BULK
+from momnisaur.knowledge import (
+    KnowledgeBase,
+    Partition,
+    index_for,
+    lexical_index_for,
+    normalize,
+    rows_frame,
+    store_exists,
+    save_store,
+    append_store,
+    migrate_csv,
+    content_hash,
+    stored_embeddings,
+)
+
+# pandas, tiktoken and openai load in the background warm-up, not when the extension is
+# imported.
+if TYPE_CHECKING:
+    import pandas as pd
+    import tiktoken
 
 SETUP_MESSAGE: dict[str, str] = {
     "role": "system",
@@ -92,70 +126,439 @@ FUNNY_WORDS: list[str] = [
     "bees",
 ]
 
-CLEAN_HTML: re.Pattern = re.compile(r"<.*?>")
-
 DATA_PATH: str = os.path.realpath(os.path.join(os.path.dirname(__file__), "..", "data"))
 print(DATA_PATH)
 
+# Store prefixes; legacy "<prefix>.csv" files are migrated on first load.
 SAVE_PATHS: dict[str, str] = {
-    "faq": f"{DATA_PATH}\\faq.csv",
-    "rules": f"{DATA_PATH}\\rules.csv",
-    "corrections": f"{DATA_PATH}\\corrections.csv",
-    "actions": f"{DATA_PATH}\\actions.csv",
+    "faq": os.path.join(DATA_PATH, "faq"),
+    "rules": os.path.join(DATA_PATH, "rules"),
+    "corrections": os.path.join(DATA_PATH, "corrections"),
+    "actions": os.path.join(DATA_PATH, "actions"),
 }
 
+QUERY_CACHE_PATH: str = os.path.join(DATA_PATH, "query_embeddings.npz")
+# Rewritten every minute in the Prometheus text format, for a textfile collector to
+# scrape.
+METRICS_PATH: str = os.path.join(DATA_PATH, "metrics.prom")
+DAD_JOKES_PATH: str = os.path.join(DATA_PATH, "dad_jokes.json")
+
 CHAT_MODEL: str = "gpt-3.5-turbo"
+WARMING_UP_MESSAGE: str = "I'm still waking up, sweetie. Ask me again in a few seconds!"
+# A failed knowledge base load is retried, waiting twice as long each time up to the cap.
+WARM_UP_RETRY_SECONDS: float = 5.0
+WARM_UP_MAX_RETRY_SECONDS: float = 300.0
+# Stream replies into the "Thinking..." message, editing it at most once per interval.
+STREAM_REPLIES: bool = True
+STREAM_EDIT_INTERVAL: float = 1.2
+MESSAGE_LIMIT: int = 1900
 EMBEDDING_MODEL: str = "text-embedding-ada-002"
+# Per-minute OpenAI limits of each model, as (requests, tokens).
+CHAT_LIMITS: tuple[float, float] = (3500, 90_000)
+EMBEDDING_LIMITS: tuple[float, float] = (3000, 1_000_000)
+# Embedding requests are cut at whichever limit a batch reaches first. The token cap
+# leaves room for EMBEDDING_CONCURRENCY batches in one minute's embedding budget.
+EMBEDDING_BATCH_SIZE: int = 1000
+EMBEDDING_CONCURRENCY: int = 4
+EMBEDDING_BATCH_TOKENS: int = min(
+    100_000, int(EMBEDDING_LIMITS[1]) // EMBEDDING_CONCURRENCY
+)
+# Retrieval fuses BM25 and embedding rankings of this many candidates each. A query
+# with a rare term whose best BM25 row scores at least LEXICAL_CONFIDENCE of the most
+# its terms could score skips the embedding; so does one whose embedding takes longer
+# than EMBEDDING_TIMEOUT. 0.3 is a row holding three quarters of the query's term weight
+# once each at the average length.
+FUSION_CANDIDATES: int = 50
+LEXICAL_CONFIDENCE: float = 0.3
+EMBEDDING_TIMEOUT: float = 3.0
+
+# Shared by every OpenAI call so bulk refreshes queue behind chat replies.
+OPENAI: OpenAIScheduler = OpenAIScheduler(
+    api_key=os.getenv("OPENAI_KEY"),
+    organization=os.getenv("OPENAI_ORG"),
+    concurrency=8,
+    limits={CHAT_MODEL: CHAT_LIMITS, EMBEDDING_MODEL: EMBEDDING_LIMITS},
+    default_limits=CHAT_LIMITS,
+)
+
+METRICS: Metrics = Metrics()
+METRICS.gauge(
+    "openai_queue_depth", "OpenAI requests waiting for a slot.", OPENAI.queue_depth
+)
+METRICS.gauge("openai_active", "OpenAI requests in flight.", lambda: OPENAI.active)
+
+# Recent messages kept per channel for chat context, and the token budget of that
+# context.
+HISTORY_SIZE: int = 20
+HISTORY_CHANNELS: int = 512
+HISTORY_TOKENS: int = 500
+
+# Timeouts of the stages of a mention reply. A stage that runs out of time or fails
+# falls back: "Thinking..." is skipped, the history or rules context is left out, or the
+# reply apologizes.
+THINKING_TIMEOUT: float = 5.0
+HISTORY_TIMEOUT: float = 5.0
+PROMPT_TIMEOUT: float = 10.0
+REPLY_TIMEOUT: float = 120.0
+DAD_JOKE_TIMEOUT: float = 30.0
+FALLBACK_REPLY: str = (
+    "Sorry sweetie, I couldn't think of an answer just now. Ask me again in a bit!"
+)
+
+# Members who finish onboarding within WELCOME_FLUSH_INTERVAL of each other are welcomed
+# together, up to WELCOME_BATCH_SIZE per message. Unfinished joins are forgotten after a
+# day.
+PENDING_MEMBER_TTL: float = 24 * 60 * 60
+WELCOME_FLUSH_INTERVAL: float = 30.0
+WELCOME_BATCH_SIZE: int = 10
 
 SCOPES = [518833007398748161, 1041764477714051103]
 
 CLEAN_NAME: re.Pattern = re.compile(r"[\W_]+")
 
+EMOJI_GUILD: int = 518833007398748161
+
+STAT_EMOJI: dict[str, int] = {
+    "toughness": 755894720546471947,
+    "resistance": 755894720927891557,
+    "dodge": 755894720588415087,
+    "willpower": 755894720932216945,
+}
+
+# Stat icons are filled in from STAT_EMOJI when the formatter is built.
+KEYWORDS: dict[str, str] = {
+    "fallen": "***FALLEN***",
+    "auto-hit": "***AUTO-HIT***",
+    "auto-crit": "***AUTO-CRIT***",
+    "piercing": "***PIERCING***",
+    "burning": "***BURNING***",
+    "chilled": "***CHILLED***",
+    "chill": "***CHILL***",
+    "dazed": "***DAZED***",
+    "daze": "***DAZE***",
+    "fragility": "***FRAGILITY***",
+    "off-guard": "***OFF-GUARD***",
+    "poisoned": "***POISONED***",
+    "poison": "***POISON***",
+    "prone": "***PRONE***",
+    "paralyzed": "***PARALYZED***",
+    "paralysis": "***PARALYSIS***",
+    "silenced": "***SILENCED***",
+    "silence": "***SILENCE***",
+    "sleeping": "***SLEEPING***",
+    "sleep": "***SLEEP***",
+    "weakness": "***WEAKNESS***",
+    "vulnerability": "***VULNERABILITY***",
+    "vs": "***VS***",
+    "toughness": "**Toughness** {toughness}",
+    "resistance": "**Resistance** {resistance}",
+    "dodge": "**Dodge** {dodge}",
+    "willpower": "**Willpower** {willpower}",
+    "critical": "**Critical (C)**",
+    "accuracy": "**Accuracy (A)**",
+    "penetration": "**Penetration (P)**",
+    "cap check": "**CAP Check**",
+    " cap": " **CAP**",
+    " dm": " Storyteller",
+}
+
+QUERY_EMBEDDINGS: EmbeddingCache = EmbeddingCache(maxsize=2048, ttl=7 * 24 * 60 * 60)
+
+# Rules questions whose embeddings are at least this similar share an answer.
+ANSWER_CACHE_THRESHOLD: float = 0.97
+ANSWERS: SemanticCache = SemanticCache(threshold=ANSWER_CACHE_THRESHOLD)
+
+# Dad jokes are served from a pool topped up in the bulk lane every
+# DAD_JOKE_REFILL_MINUTES, so adding one to a reply does not wait on a completion.
+DAD_JOKE_POOL_SIZE: int = 100
+DAD_JOKE_REFILL_MINUTES: int = 5
+DAD_JOKES: JokePool = JokePool(FUNNY_WORDS, maxsize=DAD_JOKE_POOL_SIZE)
+
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+
+async def run_stage(name: str, stage, timeout: float | None, fallback):
+    """Await a pipeline stage under a span, or return fallback if it fails."""
+    try:
+        with METRICS.span(name):
+            return await asyncio.wait_for(stage, timeout)
+    except Exception as e:
+        print(f"The {name} stage failed, falling back: {e!r}")
+        return fallback
+
 
 class AI(Extension):
     def __init__(self, bot):
-        self.new_members = []
-        self.update_rules_df()
+        self.new_members = PendingMembers(PENDING_MEMBER_TTL)
+        self.welcome_queue = []
+        self.welcome_flush = None
+        # Mention replies in progress, by the id of the message they answer.
+        self.pending_replies: dict[int, asyncio.Task] = {}
+        self.embedding_limiter = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        self.stat_icons: dict[str, str] = {name: "" for name in STAT_EMOJI}
+        self.formatter = AI.build_formatter(self.stat_icons)
+        self.history = ChannelHistory(
+            HISTORY_SIZE, max_channels=HISTORY_CHANNELS, count_tokens=AI.num_tokens
+        )
+        self.knowledge: KnowledgeBase | None = None
+        self.bot.rules_df = None
+        QUERY_EMBEDDINGS.load(QUERY_CACHE_PATH)
+        DAD_JOKES.load(DAD_JOKES_PATH)
+        self.dad_joke_refill = asyncio.Lock()
+        self.loop_watcher = None
+        # Set once the knowledge base and tokenizer are loaded; until then mentions and
+        # commands that need them get a warming up reply.
+        self.warm = threading.Event()
+        # main.py records when it started loading extensions; fall back to now.
+        self.started: float = getattr(self.bot, "started", time.perf_counter())
+        threading.Thread(target=self.warm_up, name="warm-up", daemon=True).start()
+
+    def warm_up(self):
+        """Load the tokenizer, openai and the knowledge base while the bot connects."""
+        OPENAI.client()
+        try:
+            AI.encoding()
+        except Exception as e:
+            print(f"Failed to load the tokenizer, retrying on first use: {e!r}")
+        delay = WARM_UP_RETRY_SECONDS
+        while True:
+            try:
+                self.update_rules_df()
+                break
+            except Exception as e:
+                print(
+                    f"Failed to load the knowledge base, retrying in {delay:g}s: {e!r}"
+                )
+                time.sleep(delay)
+                delay = min(delay * 2, WARM_UP_MAX_RETRY_SECONDS)
+        self.warm.set()
+        seconds = time.perf_counter() - self.started
+        METRICS.observe("warm_up", seconds, handler="startup")
+        print(f"Knowledge base ready {seconds:.2f}s after startup")
+
+    def drop(self):
+        self.save_query_embeddings()
+        self.save_dad_jokes()
+        if self.loop_watcher:
+            self.loop_watcher.cancel()
+        if self.welcome_flush:
+            self.welcome_flush.cancel()
+        super().drop()
+
+    @listen()
+    async def on_startup(self):
+        seconds = time.perf_counter() - self.started
+        METRICS.observe("gateway_ready", seconds, handler="startup")
+        print(f"Connected {seconds:.2f}s after startup")
+        self.save_query_embeddings_task.start()
+        self.refresh_emoji_task.start()
+        self.write_metrics_task.start()
+        self.refill_dad_jokes_task.start()
+        asyncio.create_task(self.refill_dad_jokes())
+        self.loop_watcher = asyncio.create_task(METRICS.watch_event_loop())
+        await self.refresh_emoji()
+
+    @staticmethod
+    def save_query_embeddings():
+        QUERY_EMBEDDINGS.save(QUERY_CACHE_PATH)
+        print(f"Query embedding cache: {QUERY_EMBEDDINGS.stats()}")
+
+    @Task.create(IntervalTrigger(minutes=15))
+    async def save_query_embeddings_task(self):
+        self.save_query_embeddings()
+
+    @staticmethod
+    def save_dad_jokes():
+        try:
+            DAD_JOKES.save(DAD_JOKES_PATH)
+        except OSError as e:
+            print(f"Failed to save dad jokes: {e}")
+        print(f"Dad joke pool: {DAD_JOKES.stats()}")
+
+    @Task.create(IntervalTrigger(minutes=DAD_JOKE_REFILL_MINUTES))
+    async def refill_dad_jokes_task(self):
+        await self.refill_dad_jokes()
+
+    async def refill_dad_jokes(self):
+        """Generate jokes in the bulk lane until the pool is full, then save it."""
+        if self.dad_joke_refill.locked():
+            return
+        async with self.dad_joke_refill:
+            added = 0
+            # Repeats are rejected, so give up once most attempts are being wasted.
+            for _ in range(2 * (DAD_JOKES.maxsize - len(DAD_JOKES))):
+                topic = DAD_JOKES.wanted()
+                if topic is None:
+                    break
+                try:
+                    joke = await AI.generate_dad_joke(topic, priority=BULK)
+                except OPENAI.errors.OpenAIError as e:
+                    print(f"Failed to refill dad jokes: {e}")
+                    break
+                added += DAD_JOKES.add(topic, joke)
+            else:
+                if DAD_JOKES.wanted() is not None:
+                    print(f"Stopped refilling dad jokes after repeats, {added} added")
+            if added:
+                self.save_dad_jokes()
+
+    @Task.create(IntervalTrigger(minutes=1))
+    async def write_metrics_task(self):
+        try:
+            METRICS.write(METRICS_PATH)
+        except OSError as e:
+            print(f"Failed to write metrics: {e}")
+
+    @staticmethod
+    @functools.cache
+    def encoding(model: str = CHAT_MODEL) -> "tiktoken.Encoding":
+        import tiktoken
+
+        return tiktoken.encoding_for_model(model)
 
     @staticmethod
     def num_tokens(text: str, model: str = CHAT_MODEL) -> int:
         """Return the number of tokens in a string."""
-        encoding = tiktoken.encoding_for_model(model)
-        return len(encoding.encode(text))
+        return len(AI.encoding(model).encode(text))
+
+    @staticmethod
+    def make_rows(
+        data: list[str], token_counts: dict[str, int] | None = None
+    ) -> list[dict]:
+        """Return knowledge base rows for data, counting each chunk's tokens once.
+
+        Chunks already in token_counts, such as ones just embedded, are not counted
+        again; the chat and embedding models share an encoding.
+        """
+        token_counts = token_counts or {}
+        return [
+            {
+                "text": text,
+                "tokens": (
+                    token_counts[text] if text in token_counts else AI.num_tokens(text)
+                ),
+                "hash": content_hash(text, EMBEDDING_MODEL),
+            }
+            for text in data
+        ]
+
+    @staticmethod
+    async def embed_query(query: str, priority: int = INTERACTIVE):
+        """Return the embedding of query, reusing a cached one for repeats."""
+        query_embedding = QUERY_EMBEDDINGS.get(query)
+        if query_embedding is None:
+            with METRICS.span("embed_query"):
+                query_embedding_response = await OPENAI.embed(
+                    model=EMBEDDING_MODEL,
+                    input=query,
+                    priority=priority,
+                )
+            query_embedding = query_embedding_response["data"][0]["embedding"]
+            QUERY_EMBEDDINGS.put(query, query_embedding)
+        return query_embedding
+
+    @staticmethod
+    async def rows_ranked_by_relatedness(
+        query: str,
+        df: "pd.DataFrame",
+        relatedness_fn=None,
+        top_n: int = 100,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Returns row positions and relatednesses, most related first."""
+        query_embedding = await AI.embed_query(query)
+        index = index_for(df)
+        if relatedness_fn is None:
+            with METRICS.span("search"):
+                return index.search(query_embedding, top_n)
+
+        relatednesses = np.array(
+            [
+                relatedness_fn(query_embedding, embedding)
+                for embedding in index.vectors()
+            ]
+        )
+        rows = np.argsort(-relatednesses, kind="stable")[:top_n]
+        return rows, relatednesses[rows]
+
+    @staticmethod
+    async def retrieve(
+        query: str, df: "pd.DataFrame", top_n: int
+    ) -> tuple[np.ndarray, list | None]:
+        """Return the best row positions for query, and its embedding if known."""
+        lexical = lexical_index_for(df)
+        with METRICS.span("lexical"):
+            lexical_rows, lexical_scores = lexical.search(query, FUSION_CANDIDATES)
+        if (
+            len(lexical_rows)
+            and lexical.confidence(query, lexical_scores[0]) >= LEXICAL_CONFIDENCE
+        ):
+            query_embedding = QUERY_EMBEDDINGS.peek(query)
+            if query_embedding is None:
+                # Embed it off the hot path so a repeat of the question can use the
+                # answer cache.
+                print("Confident lexical match, embedding the query in the background")
+                embedding = asyncio.ensure_future(AI.embed_query(query, BACKGROUND))
+                embedding.add_done_callback(
+                    lambda task: task.cancelled() or task.exception()
+                )
+            return lexical_rows[:top_n], query_embedding
+
+        embedding = asyncio.ensure_future(AI.embed_query(query))
+        # A late embedding still finishes in the background and lands in the query
+        # cache.
+        embedding.add_done_callback(lambda task: task.cancelled() or task.exception())
+        try:
+            query_embedding = await asyncio.wait_for(
+                asyncio.shield(embedding),
+                EMBEDDING_TIMEOUT if len(lexical_rows) else None,
+            )
+        except asyncio.TimeoutError:
+            print(
+                f"Query embedding took over {EMBEDDING_TIMEOUT}s, using lexical matches"
+            )
+            return lexical_rows[:top_n], None
+        except OPENAI.errors.OpenAIError as e:
+            if not len(lexical_rows):
+                raise
+            print(f"Query embedding failed, using lexical matches: {e}")
+            return lexical_rows[:top_n], None
+
+        with METRICS.span("search"):
+            embedded_rows, _ = index_for(df).search(query_embedding, FUSION_CANDIDATES)
+        return fuse([embedded_rows, lexical_rows])[:top_n], query_embedding
 
     @staticmethod
     async def strings_ranked_by_relatedness(
         query: str,
-        df: pd.DataFrame,
-        relatedness_fn=lambda x, y: 1 - spatial.distance.cosine(x, y),
+        df: "pd.DataFrame",
+        relatedness_fn=None,
         top_n: int = 100,
     ) -> tuple[list[str], list[float]]:
         """Returns a list of strings and relatednesses, sorted from most related to least."""
-        query_embedding_response = await openai.Embedding.acreate(
-            model=EMBEDDING_MODEL,
-            input=query,
+        rows, relatednesses = await AI.rows_ranked_by_relatedness(
+            query, df, relatedness_fn, top_n
         )
-        query_embedding = query_embedding_response["data"][0]["embedding"]
-        strings_and_relatednesses = [
-            (row["text"], relatedness_fn(query_embedding, row["embedding"]))
-            for i, row in df.iterrows()
-        ]
-        strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
-        strings, relatednesses = zip(*strings_and_relatednesses)
-        return strings[:top_n], relatednesses[:top_n]
+        return df["text"].iloc[rows].tolist(), relatednesses.tolist()
 
     @staticmethod
     async def query_message(
         query: str,
-        df: pd.DataFrame,
+        df: "pd.DataFrame",
         model: str,
         token_budget: int,
         custom_introduction: str = "",
+        rows=None,
     ) -> str:
-        """Return a message for GPT, with relevant source texts pulled from a dataframe."""
-        strings, relatednesses = await AI.strings_ranked_by_relatedness(
-            query, df, top_n=6
-        )
+        """Return a message for GPT, with relevant source texts pulled from a dataframe.
+
+        rows, if given, are the positions of the texts to use instead of retrieving
+        them.
+        """
+        if rows is None:
+            rows, _ = await AI.retrieve(query, df, top_n=6)
         if custom_introduction:
             introduction = custom_introduction
         else:
@@ -165,257 +568,510 @@ class AI(Extension):
                 ' found in the text, write "I could not find an answer."\n\nEmberwind rules section:\n"""'
             )
         question = f"\n\nQuestion: {query}"
+        strings = df["text"].iloc[rows].tolist()
+        if "tokens" in df:
+            string_tokens = df["tokens"].iloc[rows].tolist()
+        else:
+            string_tokens = [AI.num_tokens(string, model=model) for string in strings]
+
         message = introduction
-        for string in strings:
-            next_article = "\n" + string + "\n"
-            if (
-                AI.num_tokens(message + next_article + question, model=model)
-                > token_budget
-            ):
+        # Each article costs its stored token count plus the newline on either side.
+        total_tokens = AI.num_tokens(introduction + question, model=model)
+        for string, tokens in zip(strings, string_tokens):
+            total_tokens += tokens + 2
+            if total_tokens > token_budget:
                 break
-            else:
-                message += next_article
+            message += "\n" + string + "\n"
         return message + '"""\n\n' + question
 
     @listen()
     async def on_member_add(self, event: MemberAdd):
-        self.new_members.append(event.member)
+        self.new_members.add(int(event.member.id))
 
     @listen()
     async def on_member_update(self, event: MemberUpdate):
         if (
             MemberFlags.COMPLETED_ONBOARDING not in event.before.flags
             and MemberFlags.COMPLETED_ONBOARDING in event.after.flags
-            and event.after in self.new_members
+            and self.new_members.pop(int(event.after.id))
         ):
             print("Member Completed Onboarding")
-            response = await openai.ChatCompletion.acreate(
+            self.welcome_queue.append(event.after)
+            if len(self.welcome_queue) >= WELCOME_BATCH_SIZE:
+                await self.welcome_members()
+            elif self.welcome_flush is None or self.welcome_flush.done():
+                self.welcome_flush = asyncio.create_task(self.flush_welcomes())
+
+    async def flush_welcomes(self):
+        await asyncio.sleep(WELCOME_FLUSH_INTERVAL)
+        while self.welcome_queue:
+            await self.welcome_members()
+
+    async def welcome_members(self):
+        """Welcome up to WELCOME_BATCH_SIZE queued members with one message."""
+        members = self.welcome_queue[:WELCOME_BATCH_SIZE]
+        del self.welcome_queue[:WELCOME_BATCH_SIZE]
+        mentions = ", ".join(member.mention for member in members)
+        names = "their names" if len(members) > 1 else "their name"
+        rules_channel = self.bot.get_channel(518833140807237653)
+        try:
+            response = await OPENAI.chat(
+                priority=BACKGROUND,
                 model=CHAT_MODEL,
                 messages=[
                     SETUP_MESSAGE,
                     {
                         "role": "user",
-                        "content": f"Welcome {event.after.mention} to the ***EMBERWIND*** discord server!"
-                        f" Make sure to say their name. Mention that you can be pinged for ***EMBERWIND*** rules"
-                        f" questions in {self.bot.get_channel(518833140807237653).mention}.",
+                        "content": f"Welcome {mentions} to the ***EMBERWIND*** discord"
+                        f" server! Make sure to say {names}. Mention that you can be"
+                        f" pinged for ***EMBERWIND*** rules questions in"
+                        f" {rules_channel.mention}.",
                     },
                 ],
             )
-            self.new_members.remove(event.after)
             introduction_channel = await self.bot.fetch_channel(518834266109509632)
             await introduction_channel.send(response.choices[0].message.content)
+        except (OPENAI.errors.OpenAIError, HTTPException) as e:
+            print(f"Failed to welcome {len(members)} members: {e}")
 
-    @listen()
-    async def on_message_create(self, event: MessageCreate):
-        if "<@983043389425610873>" in event.message.content:
-            print("Processing Request")
+    def history_line(self, message) -> str:
+        """Return message as a line of chat context, or "" if it has no text."""
+        text = (
+            message.content.replace(self.bot.user.mention, "")
+            .replace("rules-search", "")
+            .strip()
+        )
+        if not text:
+            return ""
+        clean_name = CLEAN_NAME.sub("", message.author.display_name)
+        return f"{clean_name + ': ' if message.author != self.bot.user else ''}{text}"
+
+    async def recent_history(self, channel, before) -> str:
+        """Return the chat context before a message, within HISTORY_TOKENS.
+
+        Lines come from the channel's buffer; the channel history is only fetched the
+        first time a channel is seen after startup.
+        """
+        if not self.history.is_primed(int(channel.id)):
+            channel_history = await channel.history(
+                limit=HISTORY_SIZE, before=before
+            ).fetch()
+            self.history.prime(
+                int(channel.id),
+                [
+                    (int(message.id), self.history_line(message))
+                    for message in channel_history
+                ],
+            )
 
-            if "sync-commands" in event.message.content:
-                await event.message.reply("Syncing Commands")
-                await self.bot.synchronise_interactions(scopes=SCOPES)
-                return
+        history = []
+        total_tokens = 0
+        for line, tokens in self.history.before(int(channel.id), int(before)):
+            if total_tokens > HISTORY_TOKENS:
+                break
+            if not line:
+                continue
+            # Each line after the first also costs its joining newline.
+            total_tokens += tokens + (1 if history else 0)
+            history.append(line)
 
-            reply_to = event.message
-            replied_message = event.message.get_referenced_message()
-            content = event.message.content.replace("<@983043389425610873>", "").strip()
+        history.reverse()
+        return "\n".join(history)
 
-            is_rules_search = False
-            if "rules-search" in event.message.content:
-                content = content.replace("rules-search", "").strip()
-                is_rules_search = True
+    @listen()
+    async def on_message_update(self, event: MessageUpdate):
+        message = event.after
+        channel_id = AI.channel_id(message)
+        if channel_id:
+            self.history.update(channel_id, int(message.id), self.history_line(message))
+
+    @listen()
+    async def on_message_delete(self, event: MessageDelete):
+        message = event.message
+        reply = self.pending_replies.pop(int(message.id), None)
+        if reply:
+            reply.cancel()
+        channel_id = AI.channel_id(message)
+        if channel_id:
+            self.history.remove(channel_id, int(message.id))
+
+    @staticmethod
+    def channel_id(message) -> int | None:
+        """Return the id of message's channel, which may not be cached."""
+        # An edited or deleted message that was not cached only carries its channel id.
+        channel_id = getattr(message, "_channel_id", None) or getattr(
+            message.channel, "id", None
+        )
+        return int(channel_id) if channel_id else None
 
-            is_forcing_dad = False
-            if "force-dad" in event.message.content:
-                content = content.replace("force-dad", "").strip()
-                is_forcing_dad = True
+    @listen()
+    async def on_message_create(self, event: MessageCreate):
+        self.history.add(
+            int(event.message.channel.id),
+            int(event.message.id),
+            self.history_line(event.message),
+        )
+        if "<@983043389425610873>" in event.message.content:
+            message_id = int(event.message.id)
+            with METRICS.handler("mention"):
+                reply = asyncio.create_task(self.reply_to_mention(event))
+                self.pending_replies[message_id] = reply
+                try:
+                    await reply
+                except asyncio.CancelledError:
+                    # Deleting the message unregisters its reply before cancelling it.
+                    if self.pending_replies.get(message_id) is reply:
+                        raise
+                    print("Message deleted, reply cancelled")
+                finally:
+                    if self.pending_replies.get(message_id) is reply:
+                        del self.pending_replies[message_id]
+
+    async def reply_to_mention(self, event: MessageCreate):
+        """Reply to a mention, running independent stages at the same time.
+
+        "Thinking...", the chat history and the rules lookup start together, the reply
+        waits only for the two it needs, and each stage falls back instead of failing.
+        """
+        print("Processing Request")
+
+        if "sync-commands" in event.message.content:
+            await event.message.reply("Syncing Commands")
+            await self.bot.synchronise_interactions(scopes=SCOPES)
+            return
 
-            if not content and replied_message:
-                content = replied_message.content
-                reply_to = replied_message
-            elif replied_message:
-                content += "\n\nIn Reply To:\n" + replied_message.content
+        if not self.warm.is_set():
+            await event.message.reply(WARMING_UP_MESSAGE)
+            return
 
-            edit_when_done = await reply_to.reply("Thinking...")
+        reply_to = event.message
+        replied_message = event.message.get_referenced_message()
+        content = event.message.content.replace("<@983043389425610873>", "").strip()
 
-            if is_rules_search or event.message.channel == self.bot.get_channel(
-                518833140807237653
-            ):
-                message = await AI.query_message(
-                    content, self.bot.rules_df, model=CHAT_MODEL, token_budget=1024
-                )
-                print(message)
-                rules_messages = [
-                    {
-                        "role": "system",
-                        "content": "You are Momnisaur, the mother of the Nomnisaurs. You will act like a "
-                        "mother while providing helpful and informative replies. Be sure to"
-                        " speak as Momnisaur in first person. Speak about Emberwind as if you "
-                        "were part of the team that made the rules.",
-                    },
-                    {"role": "user", "content": message},
-                ]
+        is_rules_search = False
+        if "rules-search" in event.message.content:
+            content = content.replace("rules-search", "").strip()
+            is_rules_search = True
 
-                response = await openai.ChatCompletion.acreate(
-                    model=CHAT_MODEL,
-                    messages=rules_messages,
-                    temperature=0.5,
-                )
+        is_forcing_dad = False
+        if "force-dad" in event.message.content:
+            content = content.replace("force-dad", "").strip()
+            is_forcing_dad = True
 
-            else:
-                history = []
-
-                channel = event.message.channel
-                channel_history = await channel.history(
-                    limit=20, before=event.message.id
-                ).fetch()
-                for message in channel_history:
-                    if AI.num_tokens("\n".join([x for x in history])) > 500:
-                        break
-
-                    text = (
-                        message.content.replace(self.bot.user.mention, "")
-                        .replace("rules-search", "")
-                        .strip()
-                    )
-                    if not text:
-                        continue
+        if not content and replied_message:
+            content = replied_message.content
+            reply_to = replied_message
+        elif replied_message:
+            content += "\n\nIn Reply To:\n" + replied_message.content
 
-                    clean_name = CLEAN_NAME.sub("", message.author.display_name)
-                    history.append(
-                        f"{clean_name + ': ' if message.author != self.bot.user else ''}{text}"
-                    )
+        thinking = asyncio.create_task(
+            run_stage("thinking", reply_to.reply("Thinking..."), THINKING_TIMEOUT, None)
+        )
+        try:
+            reply = await self.draft_reply(
+                event, reply_to, content, is_rules_search, thinking
+            )
 
-                history.reverse()
-                history_str = "\n".join(history)
-                clean_name = CLEAN_NAME.sub("", reply_to.author.display_name)
-                full_context = (
-                    f"Use the following chat history as context when replying to this message from"
-                    f' {clean_name}.\n\nChat History:\n"""\n{history_str}""\'\n\nMessage from'
-                    f" {clean_name}: {content}"
-                )
+            reply = await run_stage("format", self.format_text(reply), None, reply)
 
-                introduction = (
-                    "The below text is are any relevant Emberwind rules if you think the question is "
-                    'about Emberwind. If it is not Emberwind related, answer normally.\n\nEmberwind rules section:\n"""'
-                )
+            if is_forcing_dad or random.randint(1, 69) == 69:
+                # A random joke is skipped when the pool is empty; a forced one is not.
+                if is_forcing_dad:
+                    joke = await run_stage(
+                        "dad_joke", AI.get_dad_joke(), DAD_JOKE_TIMEOUT, None
+                    )
+                else:
+                    joke = DAD_JOKES.take()
+                if joke:
+                    reply = reply[: len(reply) // 2] + "-\n\n" + joke
+
+            with METRICS.span("edit"):
+                await self.send_reply(reply_to, await thinking, reply)
+        except asyncio.CancelledError:
+            # Wait for "Thinking..." if it is still on its way, so it can be taken down.
+            progress = None if thinking.cancelled() else await thinking
+            if progress is not None:
+                try:
+                    await progress.delete()
+                except HTTPException as e:
+                    print(f"Failed to delete cancelled reply: {e}")
+            raise
+
+    async def draft_reply(
+        self,
+        event: MessageCreate,
+        reply_to,
+        content: str,
+        is_rules_search: bool,
+        thinking,
+    ) -> str:
+        """Return the unformatted reply, streaming it into thinking's message."""
+        if is_rules_search or event.message.channel == self.bot.get_channel(
+            518833140807237653
+        ):
+            return await run_stage(
+                "answer",
+                self.answer_rules_question(content, thinking),
+                REPLY_TIMEOUT,
+                FALLBACK_REPLY,
+            )
 
-                message = await AI.query_message(
+        introduction = (
+            "The below text is are any relevant Emberwind rules if you think the question is "
+            'about Emberwind. If it is not Emberwind related, answer normally.\n\nEmberwind rules section:\n"""'
+        )
+        history_str, message = await asyncio.gather(
+            run_stage(
+                "history",
+                self.recent_history(event.message.channel, event.message.id),
+                HISTORY_TIMEOUT,
+                "",
+            ),
+            run_stage(
+                "prompt",
+                AI.query_message(
                     content,
                     self.bot.rules_df,
                     model=CHAT_MODEL,
                     token_budget=512,
                     custom_introduction=introduction,
-                )
-                message = message.replace(f"\n\nQuestion: {content}", "")
-
-                full_prompt = f"{message}\n\n{full_context}"
-                print(full_prompt)
-                messages = [
-                    SETUP_MESSAGE,
-                    {"role": "user", "content": full_prompt},
-                ]
-                response = await openai.ChatCompletion.acreate(
-                    model=CHAT_MODEL,
-                    messages=messages,
-                )
-
-            reply = response.choices[0].message.content
-
-            reply = await self.format_text(reply)
+                ),
+                PROMPT_TIMEOUT,
+                introduction + '"""',
+            ),
+        )
+        message = message.replace(f"\n\nQuestion: {content}", "")
 
-            if is_forcing_dad or random.randint(1, 69) == 69:
-                reply = reply[: len(reply) // 2] + "-\n\n" + await AI.get_dad_joke()
+        clean_name = CLEAN_NAME.sub("", reply_to.author.display_name)
+        full_context = (
+            f"Use the following chat history as context when replying to this message from"
+            f' {clean_name}.\n\nChat History:\n"""\n{history_str}""\'\n\nMessage from'
+            f" {clean_name}: {content}"
+        )
+        full_prompt = f"{message}\n\n{full_context}"
+        print(full_prompt)
+        messages = [
+            SETUP_MESSAGE,
+            {"role": "user", "content": full_prompt},
+        ]
+        return await run_stage(
+            "reply", self.complete(messages, thinking), REPLY_TIMEOUT, FALLBACK_REPLY
+        )
 
-            if len(reply) > 1900:
-                paginator = Paginator.create_from_string(
-                    self.bot, reply, page_size=1900
-                )
-                paginator._author_id = reply_to.author
-                await edit_when_done.edit(**paginator.to_dict(), content="")
+    async def send_reply(self, reply_to, progress, reply: str):
+        """Put reply in the progress message, or reply afresh if there is none."""
+        if len(reply) > MESSAGE_LIMIT:
+            paginator = Paginator.create_from_string(
+                self.bot, reply, page_size=MESSAGE_LIMIT
+            )
+            paginator._author_id = reply_to.author
+            if progress is None:
+                await reply_to.reply(**paginator.to_dict())
             else:
-                await edit_when_done.edit(content=reply)
+                await progress.edit(**paginator.to_dict(), content="")
+        elif progress is None:
+            await reply_to.reply(reply)
+        else:
+            await progress.edit(content=reply)
+
+    async def complete(self, messages: list[dict], progress=None, **kwargs) -> str:
+        """Return the chat completion for messages.
+
+        With STREAM_REPLIES on and a progress task given, the reply is streamed and the
+        message the task returns shows the text so far until it outgrows one message.
+        """
+        if not STREAM_REPLIES or progress is None:
+            with METRICS.span("completion"):
+                response = await OPENAI.chat(
+                    model=CHAT_MODEL, messages=messages, **kwargs
+                )
+            return response.choices[0].message.content
+
+        reply = ""
+        last_edit = 0.0
+        editing = True
+        start = time.perf_counter()
+        with METRICS.span("completion"):
+            async for delta in OPENAI.stream_chat(
+                model=CHAT_MODEL, messages=messages, **kwargs
+            ):
+                if not reply and delta:
+                    METRICS.observe("first_token", time.perf_counter() - start)
+                reply += delta
+                if (
+                    not editing
+                    or not reply.strip()
+                    or time.monotonic() - last_edit < STREAM_EDIT_INTERVAL
+                ):
+                    continue
+                message = await progress
+                if message is None:
+                    editing = False
+                    continue
+                text = await self.format_text(reply)
+                if len(text) > MESSAGE_LIMIT:
+                    # The final reply goes through the paginator, so stop editing here.
+                    text = text[:MESSAGE_LIMIT] + "..."
+                    editing = False
+                last_edit = time.monotonic()
+                try:
+                    await message.edit(content=text)
+                except HTTPException as e:
+                    print(f"Failed to edit streamed reply: {e}")
+        return reply
+
+    async def answer_rules_question(self, question: str, progress=None) -> str:
+        """Answer a rules question, reusing the answer to a near-identical earlier one.
+
+        The message returned by a progress task, if given, is edited as the answer
+        streams in.
+        """
+        df = self.bot.rules_df
+        rows, query_embedding = await AI.retrieve(question, df, top_n=6)
+        if query_embedding is not None:
+            with METRICS.span("answer_cache"):
+                answer = ANSWERS.get(query_embedding)
+            if answer is not None:
+                print(f"Answer cache hit: {ANSWERS.stats()}")
+                return answer
+
+        with METRICS.span("prompt"):
+            message = await AI.query_message(
+                question, df, model=CHAT_MODEL, token_budget=1024, rows=rows
+            )
+        print(message)
+        rules_messages = [
+            {
+                "role": "system",
+                "content": "You are Momnisaur, the mother of the Nomnisaurs. You will act like a "
+                "mother while providing helpful and informative replies. Be sure to"
+                " speak as Momnisaur in first person. Speak about Emberwind as if you "
+                "were part of the team that made the rules.",
+            },
+            {"role": "user", "content": message},
+        ]
+
+        answer = await self.complete(rules_messages, progress, temperature=0.5)
+
+        # A query embedded in the background has usually landed in the query cache by
+        # now. Skip caching answers without one, and any from a knowledge base that was
+        # swapped while we were answering.
+        if query_embedding is None:
+            query_embedding = QUERY_EMBEDDINGS.peek(question)
+        if query_embedding is not None and df is self.bot.rules_df:
+            relatednesses = index_for(df).take(rows) @ normalize([query_embedding])[0]
+            ANSWERS.put(
+                query_embedding,
+                answer,
+                set(df["source"].iloc[rows]),
+                floor=float(relatednesses.min()) if len(rows) == 6 else -1.0,
+            )
+        return answer
 
     async def format_text(self, text):
-        toughness_icon = await self.bot.fetch_custom_emoji(
-            755894720546471947, 518833007398748161
-        )
-        resistance_icon = await self.bot.fetch_custom_emoji(
-            755894720927891557, 518833007398748161
-        )
-        dodge_icon = await self.bot.fetch_custom_emoji(
-            755894720588415087, 518833007398748161
-        )
-        willpower_icon = await self.bot.fetch_custom_emoji(
-            755894720932216945, 518833007398748161
+        return self.formatter.format(text)
+
+    async def refresh_emoji(self):
+        """Fetch the stat icons and rebuild the formatter if any of them changed."""
+        icons = await asyncio.gather(
+            *(
+                self.bot.fetch_custom_emoji(emoji_id, EMOJI_GUILD)
+                for emoji_id in STAT_EMOJI.values()
+            )
         )
-        # define desired replacements here
-        rep = {
-            "fallen": "***FALLEN***",
-            "auto-hit": "***AUTO-HIT***",
-            "auto-crit": "***AUTO-CRIT***",
-            "piercing": "***PIERCING***",
-            "burning": "***BURNING***",
-            "chilled": "***CHILLED***",
-            "chill": "***CHILL***",
-            "dazed": "***DAZED***",
-            "daze": "***DAZE***",
-            "fragility": "***FRAGILITY***",
-            "off-guard": "***OFF-GUARD***",
-            "poisoned": "***POISONED***",
-            "poison": "***POISON***",
-            "prone": "***PRONE***",
-            "paralyzed": "***PARALYZED***",
-            "paralysis": "***PARALYSIS***",
-            "silenced": "***SILENCED***",
-            "silence": "***SILENCE***",
-            "sleeping": "***SLEEPING***",
-            "sleep": "***SLEEP***",
-            "weakness": "***WEAKNESS***",
-            "vulnerability": "***VULNERABILITY***",
-            "vs": "***VS***",
-            "toughness": f"**Toughness** {toughness_icon}",
-            "resistance": f"**Resistance** {resistance_icon}",
-            "dodge": f"**Dodge** {dodge_icon}",
-            "willpower": f"**Willpower** {willpower_icon}",
-            "critical": "**Critical (C)**",
-            "accuracy": "**Accuracy (A)**",
-            "penetration": "**Penetration (P)**",
-            "cap check": "**CAP Check**",
-            " cap": " **CAP**",
-            " dm": " Storyteller",
+        icons = {
+            name: str(icon) if icon else "" for name, icon in zip(STAT_EMOJI, icons)
         }
-        extended_rep = {}
-        for key, value in rep.items():
-            extended_rep[key.title()] = value
-            extended_rep[key.upper()] = value
-        rep.update(extended_rep)
-        # use these three lines to do the replacement
-        rep = dict((re.escape(k), v) for k, v in rep.items())
-        pattern = re.compile("|".join(rep.keys()))
-        pattern2 = re.compile(r"\*{4,}")
-        text = pattern.sub(lambda m: rep[re.escape(m.group(0))], text)
-        text = pattern2.sub("***", text)
-        return text
-
-    def update_rules_df(self):
-        self.bot.rules_df = pd.concat(
-            (pd.read_csv(path) for path in SAVE_PATHS.values() if os.path.isfile(path)),
-            ignore_index=True,
+        if icons != self.stat_icons:
+            self.stat_icons = icons
+            self.formatter = AI.build_formatter(icons)
+
+    @staticmethod
+    def build_formatter(icons: dict[str, str]) -> KeywordFormatter:
+        return KeywordFormatter(
+            {key: value.format(**icons) for key, value in KEYWORDS.items()}
         )
-        self.bot.rules_df["embedding"] = self.bot.rules_df["embedding"].apply(
-            ast.literal_eval
+
+    @Task.create(IntervalTrigger(hours=1))
+    async def refresh_emoji_task(self):
+        await self.refresh_emoji()
+
+    def load_partition(self, source: str) -> Partition | None:
+        prefix = SAVE_PATHS[source]
+        if not store_exists(prefix):
+            if not os.path.isfile(f"{prefix}.csv"):
+                return None
+            print(f"Migrating {prefix}.csv")
+            migrate_csv(f"{prefix}.csv", prefix, count_tokens=AI.num_tokens)
+        return Partition.from_store(source, prefix, count_tokens=AI.num_tokens)
+
+    def swap_partitions(self, *partitions: Partition):
+        """Replace partitions in the live knowledge base in one step."""
+        self.knowledge = (self.knowledge or KnowledgeBase()).replace(*partitions)
+        self.bot.rules_df = self.knowledge.frame
+
+    def update_rules_df(self, *sources: str):
+        """Reload the given sources, or all, and swap them into the knowledge base."""
+        partitions = [self.load_partition(source) for source in sources or SAVE_PATHS]
+        self.swap_partitions(*filter(None, partitions))
+        ANSWERS.invalidate(sources or SAVE_PATHS)
+
+    async def rebuild_knowledge(self, update):
+        """Swap in update(knowledge base), computed in a worker thread.
+
+        If the knowledge base was swapped while update ran, it is applied again to the
+        new one so neither change is lost.
+        """
+        while True:
+            base = self.knowledge
+            knowledge = await asyncio.to_thread(update, base or KnowledgeBase())
+            if self.knowledge is base:
+                break
+        self.knowledge = knowledge
+        self.bot.rules_df = knowledge.frame
+
+    async def refresh_rules_df(self, *sources: str):
+        """Like update_rules_df, but loads and builds the snapshot in a thread.
+
+        Queries that already hold the old rules_df keep searching that snapshot.
+        """
+        partitions = await asyncio.to_thread(
+            lambda: [self.load_partition(source) for source in sources or SAVE_PATHS]
+        )
+        await self.rebuild_knowledge(
+            lambda knowledge: knowledge.replace(*filter(None, partitions))
         )
+        ANSWERS.invalidate(sources or SAVE_PATHS)
+
+    async def extend_rules_df(self, source: str, rows: list[dict], embeddings):
+        """Add rows to the live knowledge base without reloading any stored source."""
+
+        def extend(knowledge: KnowledgeBase) -> KnowledgeBase:
+            partition = knowledge.partitions.get(source) or Partition(
+                source, rows_frame([], source), []
+            )
+            return knowledge.replace(partition.extend(rows, embeddings))
+
+        await self.rebuild_knowledge(extend)
 
     @staticmethod
     def update_command(name, description=""):
         def wrapper(func):
+            @functools.wraps(func)
+            async def timed(self, ctx: SlashContext):
+                if not self.warm.is_set():
+                    await ctx.send(WARMING_UP_MESSAGE, ephemeral=True)
+                    return
+                with METRICS.handler(f"update_{name}"):
+                    return await func(self, ctx)
+
             return slash_command(
                 name="update",
                 description="Updates one of the Momnisaur's data files.",
                 sub_cmd_name=name,
                 sub_cmd_description=description,
                 scopes=SCOPES,
-            )(func)
+            )(timed)
 
         return wrapper
 
@@ -424,236 +1080,182 @@ class AI(Extension):
     async def get_knowledge_base(self, ctx: SlashContext):
         await ctx.send("Updating Knowledge Base Embeddings")
 
-        headers = {"Emberwind-Api-Key": EMBERWIND_KEY}
-        params = {
-            "page": 0,
-            "size": 1000,
-        }
-
-        data = []
-
-        async with aiohttp.ClientSession(headers=headers) as session:
-            url = "https://emberwindgame.com/emberwind-web/api/v1/web/content/faq"
-            async with session.get(url, params=params) as resp:
-                result = await resp.json()
-                for faq in result["data"]:
-                    async with session.get(f"{url}/{faq['slug']}") as faq_resp:
-                        question = await faq_resp.json()
-                        formatted = (
-                            f"{' '.join(x['name'] for x in question['path'])}\n"
-                            f"{question['question']}\n"
-                            f"{question['answer']}"
-                        )
-                        formatted = re.sub(CLEAN_HTML, " ", formatted)
-                        data.append(
-                            formatted.replace("#", "")
-                            .replace("@", "")
-                            .replace("$", "")
-                            .strip()
-                        )
-
-        embeddings = await self.get_embeddings_from_data(data)
-
-        df = pd.DataFrame({"text": data, "embedding": embeddings})
-        df.to_csv(SAVE_PATHS["faq"], index=False)
-        self.update_rules_df()
+        try:
+            async with ingest.session() as session:
+                summary = await self.refresh_source(
+                    "faq", ingest.faq_documents(session)
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await ctx.send(f"Failed to fetch the Emberwind FAQ: {e}")
+            return
 
-        await ctx.send("Finished Updating Local Knowledge Base")
+        await ctx.send(f"Finished Updating Local Knowledge Base ({summary})")
 
     @update_command(name="comprehensive_rules")
     @check(has_role(525501383189856278))
     async def update_rules(self, ctx: SlashContext):
         await ctx.send("Updating Comprehensive Rules Embeddings")
 
-        with open(f"{DATA_PATH}\\RAWRules.txt", "r", encoding="utf8") as rules:
+        with open(
+            os.path.join(DATA_PATH, "RAWRules.txt"), "r", encoding="utf8"
+        ) as rules:
             rules_text = rules.read()
             data = [rule.strip() for rule in rules_text.split(";/.")]
 
-        embeddings = await self.get_embeddings_from_data(data)
+        summary = await self.refresh_source("rules", iterate(data))
 
-        df = pd.DataFrame({"text": data, "embedding": embeddings})
-        df.to_csv(f"{DATA_PATH}\\rules.csv", index=False)
-        self.update_rules_df()
-
-        await ctx.send("Finished Updating Local Comprehensive Rules")
+        await ctx.send(f"Finished Updating Local Comprehensive Rules ({summary})")
 
     @update_command(name="hero_actions")
     @check(has_role(525501383189856278))
     async def get_hero_actions(self, ctx: SlashContext):
         await ctx.send("Updating Hero Actions Embeddings")
 
-        headers = {"Emberwind-Api-Key": EMBERWIND_KEY}
-
-        data = []
-        classes = [
-            "archer",
-            "ardent",
-            "atlanta",
-            "druid",
-            "invoker",
-            "rogue",
-            "spiritualist",
-            "tactician",
-            "warrior",
-        ]
-
-        subclasses = [
-            "elysian_legionnaire",
-            "hekau",
-            "nightshade",
-            "saviour",
-            "wildfang",
-        ]
-
-        async with aiohttp.ClientSession(headers=headers) as session:
-            auth_url = "https://emberwindgame.com/emberwind-web/api/v1/web/auth/login"
-            body = json.dumps(
-                {
-                    "email": EMBERWIND_EMAIL,
-                    "password": EMBERWIND_PASSWORD,
-                    "rememberMe": False,
-                }
-            )
-
-            async with session.post(
-                auth_url,
-                data=body,
-                headers={"Content-Type": "application/json", "Accept": "*/*"},
-            ) as resp:
-                if resp.status != 200:
+        try:
+            async with ingest.session() as session:
+                if not await ingest.login(session):
                     await ctx.send("Failed to login to Emberwind")
                     return
 
-            for hero_class in classes:
-                url = (
-                    f"https://emberwindgame.com/emberwind-web/api/v1/web/heroes/hero-creator/classes/"
-                    f"{hero_class}/options/up-to-tier/4"
-                )
-                async with session.get(url) as resp:
-                    result = await resp.json()
-                    for tier in result:
-                        for action, category in [
-                            *[(t, "Trait") for t in tier["traits"]],
-                            *[(a, "Class Action") for a in tier["actions"]],
-                            *[
-                                (t, "Tide Turner Action")
-                                for t in tier["tideTurnerActions"]
-                            ],
-                        ]:
-                            name = action.get("name", "")
-                            type = action.get("type", "")
-                            subtype = action.get("subtype", "")
-                            target = action.get("target", "")
-                            range_description = action.get("rangeDescription", "")
-                            action_range = action.get("range", "")
-                            action_speed = action.get("actionSpeed", "")
-                            effect = action.get("effect", "")
-
-                            formatted = f"Class: {hero_class.capitalize()}\n"
-                            formatted += f"{category}: {name}\n"
-                            if type == "Passive":
-                                formatted += f"Type: {type}\n"
-                            else:
-                                formatted += f"Type: {type} / {subtype}\n"
-                                formatted += f"Target: {target}\n"
-                                if action_range:
-                                    formatted += (
-                                        f"Range: {range_description} / {action_range}\n"
-                                    )
-                                formatted += f"Speed: {action_speed}\n"
-                            formatted += f"Effect: {effect}"
-
-                            formatted = re.sub(CLEAN_HTML, " ", formatted)
-                            data.append(
-                                formatted.replace("#", "")
-                                .replace("@", "")
-                                .replace("$", "")
-                                .strip()
-                            )
-
-            for subclass in subclasses:
-                url = (
-                    f"https://emberwindgame.com/emberwind-web/api/v1/web/heroes/hero-creator/subclasses/"
-                    f"{subclass}/options/up-to-tier/4"
+                summary = await self.refresh_source(
+                    "actions", ingest.hero_action_documents(session)
                 )
-                async with session.get(url) as resp:
-                    result = await resp.json()
-                    for tier in result:
-                        for action, category in [
-                            *[(t, "Trait") for t in tier["traits"]],
-                            *[(a, "Class Action") for a in tier["actions"]],
-                            *[
-                                (t, "Tide Turner Action")
-                                for t in tier["tideTurnerActions"]
-                            ],
-                        ]:
-                            name = action.get("name", "")
-                            type = action.get("type", "")
-                            subtype = action.get("subtype", "")
-                            target = action.get("target", "")
-                            range_description = action.get("rangeDescription", "")
-                            action_range = action.get("range", "")
-                            action_speed = action.get("actionSpeed", "")
-                            effect = action.get("effect", "")
-
-                            formatted = f"Class: {subclass.capitalize()}\n"
-                            formatted += f"{category}: {name}\n"
-                            if type == "Passive":
-                                formatted += f"Type: {type}\n"
-                            else:
-                                formatted += f"Type: {type} / {subtype}\n"
-                                formatted += f"Target: {target}\n"
-                                if action_range:
-                                    formatted += (
-                                        f"Range: {range_description} / {action_range}\n"
-                                    )
-                                formatted += f"Speed: {action_speed}\n"
-                            formatted += f"Effect: {effect}"
-
-                            formatted = re.sub(CLEAN_HTML, " ", formatted)
-                            data.append(
-                                formatted.replace("#", "")
-                                .replace("@", "")
-                                .replace("$", "")
-                                .strip()
-                            )
-
-        embeddings = await self.get_embeddings_from_data(data)
-
-        df = pd.DataFrame({"text": data, "embedding": embeddings})
-        df.to_csv(SAVE_PATHS["actions"], index=False)
-        self.update_rules_df()
-
-        await ctx.send("Finished Updating Local Hero Actions")
-
-    async def get_embeddings_from_data(self, data):
-        batch_size = 1000
-        embeddings = []
-        for batch_start in range(0, len(data), batch_size):
-            batch_end = batch_start + batch_size
-            batch = data[batch_start:batch_end]
-            print(f"Batch {batch_start} to {batch_end - 1}")
-            response = await openai.Embedding.acreate(
-                model=EMBEDDING_MODEL, input=batch
-            )
-            for i, be in enumerate(response["data"]):
-                assert i == be["index"]
-            batch_embeddings = [e["embedding"] for e in response["data"]]
-            embeddings.extend(batch_embeddings)
-        return embeddings
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await ctx.send(f"Failed to fetch Emberwind hero actions: {e}")
+            return
 
-    async def update_corrections(self):
-        with open(
-            f"{DATA_PATH}\\corrections.txt", "r", encoding="utf8"
-        ) as corrections_file:
-            corrections_text = corrections_file.read().strip().strip(";/.")
-            data = [correction.strip() for correction in corrections_text.split(";/.")]
+        await ctx.send(f"Finished Updating Local Hero Actions ({summary})")
+
+    async def refresh_source(self, source: str, documents) -> str:
+        """Save documents as the given source, embedding only new chunks.
 
-        embeddings = await self.get_embeddings_from_data(data)
+        Returns a summary of how many chunks were reused, added and removed.
+        """
+        with METRICS.span("hash_scan"):
+            stored = await asyncio.to_thread(
+                lambda: {
+                    name: stored_embeddings([prefix], EMBEDDING_MODEL)
+                    for name, prefix in SAVE_PATHS.items()
+                }
+            )
+        known = {h: e for vectors in stored.values() for h, e in vectors.items()}
+        previous = set(stored.get(source, ()))
 
-        df = pd.DataFrame({"text": data, "embedding": embeddings})
-        df.to_csv(f"{DATA_PATH}\\corrections.csv", index=False)
-        self.update_rules_df()
+        token_counts = {}
+        with METRICS.span("embed"):
+            data, embeddings = await self.get_embeddings_from_stream(
+                documents, known, token_counts
+            )
+        with METRICS.span("save"):
+            rows = await asyncio.to_thread(self.make_rows, data, token_counts)
+            await asyncio.to_thread(save_store, SAVE_PATHS[source], rows, embeddings)
+        with METRICS.span("reload"):
+            await self.refresh_rules_df(source)
+        added = [e for row, e in zip(rows, embeddings) if row["hash"] not in known]
+        ANSWERS.invalidate(added=added)
+
+        hashes = {row["hash"] for row in rows}
+        reused = sum(row["hash"] in known for row in rows)
+        summary = (
+            f"{reused} reused, {len(rows) - reused} added, "
+            f"{len(previous - hashes)} removed"
+        )
+        print(f"Refreshed {source}: {summary}")
+        return summary
+
+    async def get_embeddings_from_stream(
+        self,
+        documents,
+        known: dict | None = None,
+        token_counts: dict[str, int] | None = None,
+    ) -> tuple[list[str], list]:
+        """Embed documents from an async iterator, sending each batch once full.
+
+        Documents whose content hash is in known reuse that vector instead of being
+        embedded. The token counts of embedded documents go into token_counts.
+        """
+        known = known or {}
+        data = []
+        hashes = []
+        batch = []
+        tasks = []
+        try:
+            async for document in documents:
+                data.append(document)
+                hashes.append(content_hash(document, EMBEDDING_MODEL))
+                if hashes[-1] in known:
+                    continue
+                batch.append(document)
+                if len(batch) == EMBEDDING_BATCH_SIZE:
+                    tasks.append(
+                        asyncio.create_task(
+                            self.get_embeddings_from_data(batch, token_counts)
+                        )
+                    )
+                    batch = []
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        if batch:
+            tasks.append(
+                asyncio.create_task(self.get_embeddings_from_data(batch, token_counts))
+            )
+        fresh = iter([e for result in await asyncio.gather(*tasks) for e in result])
+        embeddings = [known[h] if h in known else next(fresh) for h in hashes]
+        return data, embeddings
+
+    async def get_embeddings_from_data(
+        self, data, token_counts: dict[str, int] | None = None
+    ):
+        """Embed data in concurrent token-bounded batches, returning them in order.
+
+        The token count of each chunk goes into token_counts, if given.
+        """
+        counts = await asyncio.to_thread(
+            lambda: [AI.num_tokens(text, model=EMBEDDING_MODEL) for text in data]
+        )
+        if token_counts is not None:
+            token_counts.update(zip(data, counts))
+        batches = []
+        batch_start = 0
+        batch_tokens = 0
+        for i, tokens in enumerate(counts):
+            if i > batch_start and (
+                batch_tokens + tokens > EMBEDDING_BATCH_TOKENS
+                or i - batch_start == EMBEDDING_BATCH_SIZE
+            ):
+                batches.append((batch_start, i))
+                batch_start = i
+                batch_tokens = 0
+            batch_tokens += tokens
+        if batch_start < len(data):
+            batches.append((batch_start, len(data)))
+
+        results = await asyncio.gather(
+            *(self.embed_batch(data[start:end], start) for start, end in batches)
+        )
+        return [embedding for result in results for embedding in result]
+
+    async def embed_batch(self, batch: list[str], batch_start: int = 0):
+        """Embed one batch, retrying it alone if the request fails."""
+        async with self.embedding_limiter:
+            print(f"Batch {batch_start} to {batch_start + len(batch) - 1}")
+            response = await OPENAI.embed(
+                model=EMBEDDING_MODEL, input=batch, priority=BULK
+            )
+        for i, be in enumerate(response["data"]):
+            assert i == be["index"]
+        return [e["embedding"] for e in response["data"]]
+
+    async def add_correction(self, text: str):
+        """Embed one correction, append it to the store and add it to the live index."""
+        token_counts = {}
+        embeddings = await self.get_embeddings_from_data([text], token_counts)
+        rows = self.make_rows([text], token_counts)
+        append_store(SAVE_PATHS["corrections"], rows, embeddings)
+        await self.extend_rules_df("corrections", rows, embeddings)
+        ANSWERS.invalidate(added=embeddings)
 
     @message_context_menu(
         name="Correct",
@@ -664,6 +1266,9 @@ class AI(Extension):
         if ctx.target.author.id != self.bot.user.id:
             await ctx.send("I can only correct my own messages.", ephemeral=True)
             return
+        if not self.warm.is_set():
+            await ctx.send(WARMING_UP_MESSAGE, ephemeral=True)
+            return
 
         print("Correcting")
 
@@ -688,29 +1293,59 @@ class AI(Extension):
         modal_ctx = await self.bot.wait_for_modal(modal)
         await modal_ctx.defer(ephemeral=True)
 
-        response = await openai.ChatCompletion.acreate(
-            model=CHAT_MODEL,
-            messages=[
-                SETUP_MESSAGE,
-                {"role": "user", "content": question},
-                {"role": "assistant", "content": ctx.target.content},
-                {
-                    "role": "user",
-                    "content": f"State that you were wrong and the correct answer is: "
-                    f"{modal_ctx.responses['correct_answer']}. "
-                    f"Respond as if you were correcting yourself.",
-                },
-            ],
-        )
+        # Timed from the modal submission, so the time spent typing is not counted.
+        with METRICS.handler("correct"):
+            await self.apply_correction(ctx, modal_ctx, reply_to, question)
+
+    async def apply_correction(self, ctx, modal_ctx, reply_to, question: str):
+        with METRICS.span("completion"):
+            response = await OPENAI.chat(
+                model=CHAT_MODEL,
+                messages=[
+                    SETUP_MESSAGE,
+                    {"role": "user", "content": question},
+                    {"role": "assistant", "content": ctx.target.content},
+                    {
+                        "role": "user",
+                        "content": f"State that you were wrong and the correct answer is: "
+                        f"{modal_ctx.responses['correct_answer']}. "
+                        f"Respond as if you were correcting yourself.",
+                    },
+                ],
+            )
 
-        reply = await self.format_text(response.choices[0].message.content)
-        await reply_to.reply(reply)
-        await modal_ctx.send("Corrected")
+        with METRICS.span("reply"):
+            reply = await self.format_text(response.choices[0].message.content)
+            await reply_to.reply(reply)
+            await modal_ctx.send("Corrected")
 
-        with open(f"{DATA_PATH}\\corrections.txt", "a+") as file:
-            file.write(f"{question}\n{modal_ctx.responses['correct_answer']}\n;/.\n")
+        correction = f"{question}\n{modal_ctx.responses['correct_answer']}"
+        with METRICS.span("store"):
+            with open(os.path.join(DATA_PATH, "corrections.txt"), "a+") as file:
+                file.write(f"{correction}\n;/.\n")
 
-        await self.update_corrections()
+            await self.add_correction(correction.strip())
+
+    @slash_command(
+        name="metrics",
+        scopes=SCOPES,
+        description="Show reply latency by stage",
+    )
+    @check(is_owner())
+    async def metrics(self, ctx: SlashContext):
+        await ctx.send(f"```\n{METRICS.summary()[:MESSAGE_LIMIT]}\n```", ephemeral=True)
+
+    @slash_command(
+        name="openai_queue",
+        scopes=SCOPES,
+        description="Show the OpenAI request queue",
+    )
+    @check(is_owner())
+    async def openai_queue(self, ctx: SlashContext):
+        await ctx.send(
+            f"```\n{OPENAI.stats()}\nDad joke pool: {DAD_JOKES.stats()}\n```",
+            ephemeral=True,
+        )
 
     @slash_command(name="dad_joke", scopes=SCOPES, description="Get a random dad joke")
     async def dad_joke(self, ctx: SlashContext):
@@ -719,14 +1354,22 @@ class AI(Extension):
         await ctx.send(joke)
 
     @staticmethod
-    async def get_dad_joke():
-        response = await openai.ChatCompletion.acreate(
+    async def get_dad_joke() -> str:
+        """Return a pooled dad joke, or a freshly generated one if the pool is empty."""
+        return DAD_JOKES.take() or await AI.generate_dad_joke(
+            random.choice(FUNNY_WORDS)
+        )
+
+    @staticmethod
+    async def generate_dad_joke(topic: str, priority: int = INTERACTIVE) -> str:
+        response = await OPENAI.chat(
+            priority=priority,
             model=CHAT_MODEL,
             messages=[
                 DADDISAUR_MESSAGE,
                 {
                     "role": "user",
-                    "content": f"Tell me a dad joke about {random.choice(FUNNY_WORDS)}. Wrap the joke "
+                    "content": f"Tell me a dad joke about {topic}. Wrap the joke "
                     f"in quotation marks. Prefix the joke with a note in italics about "
                     f"Daddisaur chiming in from another room or entering the room and "
                     f"leaving after. Use proper grammar and punctuation.",
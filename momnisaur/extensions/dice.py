@@ -1,13 +1,20 @@
-import dice
+import asyncio
 
 from interactions import Extension, slash_command, SlashContext, slash_option, OptionType
 
+from momnisaur.odds import describe
+from momnisaur.rolling import RollSandbox, RollRejected
+
 SCOPES = [518833007398748161, 1041764477714051103]
 
 
 class Dice(Extension):
     def __init__(self, bot):
-        pass
+        self.sandbox = RollSandbox()
+
+    def drop(self):
+        self.sandbox.kill()
+        super().drop()
 
     @slash_command(
         name="roll",
@@ -23,10 +30,36 @@ class Dice(Extension):
     )
     async def roll(self, ctx: SlashContext, dice_roll: str):
         await ctx.defer()
-        result: dice.elements.Element = dice.roll(dice_roll)
-        if type(result) == dice.elements.Roll:
-            result = sum(result)
-        await ctx.send(f"{dice_roll} -> {result}")
+        try:
+            result = await self.sandbox.roll(dice_roll)
+        except RollRejected as e:
+            await ctx.send(f"{dice_roll} -> Can't roll that: {e}")
+            return
+        await ctx.send(f"{dice_roll} -> {result}"[:2000])
+
+    @slash_command(
+        name="odds", description="Shows the exact odds of a dice roll", scopes=SCOPES
+    )
+    @slash_option(
+        name="dice",
+        description="The dice to roll, like 3d6+2 or 4d6h3",
+        opt_type=OptionType.STRING,
+        required=True,
+        argument_name="dice_roll",
+    )
+    @slash_option(
+        name="target",
+        description="Also show the chance of rolling at least this",
+        opt_type=OptionType.INTEGER,
+        required=False,
+    )
+    async def odds(self, ctx: SlashContext, dice_roll: str, target: int | None = None):
+        try:
+            summary = await asyncio.to_thread(describe, dice_roll, target)
+        except RollRejected as e:
+            await ctx.send(f"{dice_roll} -> Can't work out odds: {e}", ephemeral=True)
+            return
+        await ctx.send(f"**{dice_roll}**\n{summary}")
 
 
 def setup(bot):
@@ -1,6 +1,44 @@
+import asyncio
+import random
+import re
+
 import asyncpraw
 
-from interactions import slash_command, slash_option, SlashContext, Extension, OptionType, Client, Embed, listen
+from interactions import (
+    slash_command,
+    slash_option,
+    SlashContext,
+    Extension,
+    OptionType,
+    Client,
+    Embed,
+    listen,
+    check,
+    is_owner,
+)
+from interactions.client.errors import HTTPException
+
+from momnisaur.relay import RelayQueue
+
+SCOPES = [518833007398748161, 1041764477714051103]
+
+RELAY_CHANNEL: int = 1042831507154292816
+STREAM_SUBREDDIT: str = "all"
+# Only submissions from these subreddits, or whose titles contain one of these keywords,
+# are relayed. An empty filter lets everything through.
+SUBREDDITS: set[str] = set()
+KEYWORDS: list[str] = []
+
+QUEUE_SIZE: int = 200
+SEEN_SIZE: int = 10_000
+# One message carries up to DIGEST_SIZE links, sent at most once per DIGEST_INTERVAL.
+DIGEST_SIZE: int = 10
+DIGEST_INTERVAL: float = 5.0
+MESSAGE_LIMIT: int = 1900
+RECONNECT_BACKOFF: float = 5.0
+MAX_RECONNECT_BACKOFF: float = 300.0
+
+URL_START: str = "http://www.reddit.com"
 
 
 class Reddit(Extension):
@@ -16,17 +54,84 @@ class Reddit(Extension):
             user_agent = self.user_agent
         )
 
+        self.subreddits = {name.casefold() for name in SUBREDDITS}
+        self.keywords = (
+            re.compile("|".join(re.escape(k) for k in KEYWORDS), re.IGNORECASE)
+            if KEYWORDS
+            else None
+        )
+        self.queue = RelayQueue(QUEUE_SIZE, seen=SEEN_SIZE)
+        self.reconnects = 0
+        self.tasks = []
+
+    def drop(self):
+        for task in self.tasks:
+            task.cancel()
+        asyncio.create_task(self.reddit.close())
+        super().drop()
+
     @listen()
-    async def on_ready(self):
+    async def on_startup(self):
         print("Reddit loaded")
-        channel = self.bot.get_channel(1042831507154292816)
-        subreddit = await self.reddit.subreddit('all')
-        urlstart = "http://www.reddit.com/"
-        async for submissions in subreddit.stream.submissions():
+        self.tasks = [
+            asyncio.create_task(self.stream()),
+            asyncio.create_task(self.deliver()),
+        ]
+
+    def wanted(self, submission) -> bool:
+        if not self.subreddits and not self.keywords:
+            return True
+        if submission.subreddit.display_name.casefold() in self.subreddits:
+            return True
+        return bool(self.keywords and self.keywords.search(submission.title))
+
+    async def stream(self):
+        """Queue wanted submissions, reconnecting with backoff when the stream fails."""
+        backoff = RECONNECT_BACKOFF
+        while True:
             try:
-                await channel.send(urlstart+submissions.permalink)
+                subreddit = await self.reddit.subreddit(STREAM_SUBREDDIT)
+                async for submission in subreddit.stream.submissions(
+                    skip_existing=True
+                ):
+                    backoff = RECONNECT_BACKOFF
+                    if self.wanted(submission):
+                        self.queue.offer(
+                            submission.id,
+                            URL_START + submission.permalink,
+                            submission.created_utc,
+                        )
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                pass
+                self.reconnects += 1
+                delay = backoff * (1 + random.random())
+                print(f"Reddit stream failed, reconnecting in {delay:.0f}s: {e!r}")
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, MAX_RECONNECT_BACKOFF)
+
+    async def deliver(self):
+        """Send queued links in digests, at most one message per DIGEST_INTERVAL."""
+        while True:
+            lines = await self.queue.digest(DIGEST_SIZE, MESSAGE_LIMIT, DIGEST_INTERVAL)
+            try:
+                channel = await self.bot.fetch_channel(RELAY_CHANNEL)
+                await channel.send("\n".join(lines))
+            except HTTPException as e:
+                print(f"Failed to relay {len(lines)} Reddit links: {e}")
+            await asyncio.sleep(DIGEST_INTERVAL)
+
+    @slash_command(
+        name="reddit_relay",
+        scopes=SCOPES,
+        description="Show the Reddit relay queue",
+    )
+    @check(is_owner())
+    async def reddit_relay(self, ctx: SlashContext):
+        await ctx.send(
+            f"```\n{self.queue.stats()}\n{self.reconnects} reconnects\n```",
+            ephemeral=True,
+        )
 
 
 def setup(bot):
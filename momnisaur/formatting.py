@@ -0,0 +1,21 @@
+import re
+
+EXTRA_STARS: re.Pattern = re.compile(r"\*{4,}")
+
+
+class KeywordFormatter:
+    """Replaces keywords and their title- and upper-case variants in one pass."""
+
+    def __init__(self, replacements: dict[str, str]):
+        rep = dict(replacements)
+        extended_rep = {}
+        for key, value in replacements.items():
+            extended_rep[key.title()] = value
+            extended_rep[key.upper()] = value
+        rep.update(extended_rep)
+        self.replacements: dict[str, str] = rep
+        self.pattern: re.Pattern = re.compile("|".join(re.escape(k) for k in rep))
+
+    def format(self, text: str) -> str:
+        text = self.pattern.sub(lambda m: self.replacements[m.group(0)], text)
+        return EXTRA_STARS.sub("***", text)
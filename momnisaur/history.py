@@ -0,0 +1,74 @@
+from collections import OrderedDict, deque
+
+
+class ChannelHistory:
+    """Bounded buffers of the most recent message lines per channel.
+
+    Each entry is [message id, line, token count]; token counts are filled in the first
+    time a line is used and kept after that. Channels are evicted least recently used.
+    """
+
+    def __init__(self, size: int = 20, max_channels: int = 512, count_tokens=len):
+        self.size = size
+        self.max_channels = max_channels
+        self.count_tokens = count_tokens
+        self._channels: OrderedDict[int, deque] = OrderedDict()
+        self._primed: set[int] = set()
+
+    def _buffer(self, channel_id: int) -> deque:
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            buffer = self._channels[channel_id] = deque(maxlen=self.size)
+            while len(self._channels) > self.max_channels:
+                evicted, _ = self._channels.popitem(last=False)
+                self._primed.discard(evicted)
+        self._channels.move_to_end(channel_id)
+        return buffer
+
+    def is_primed(self, channel_id: int) -> bool:
+        return channel_id in self._primed
+
+    def add(self, channel_id: int, message_id: int, line: str):
+        buffer = self._buffer(channel_id)
+        if buffer and buffer[-1][0] > message_id:
+            # Out of order; rebuild the buffer sorted.
+            self.prime(
+                channel_id, [(message_id, line)], primed=self.is_primed(channel_id)
+            )
+        else:
+            buffer.append([message_id, line, None])
+
+    def update(self, channel_id: int, message_id: int, line: str):
+        for entry in self._channels.get(channel_id, ()):
+            if entry[0] == message_id:
+                entry[1] = line
+                entry[2] = None
+
+    def remove(self, channel_id: int, message_id: int):
+        buffer = self._channels.get(channel_id)
+        if buffer is not None:
+            for entry in list(buffer):
+                if entry[0] == message_id:
+                    buffer.remove(entry)
+
+    def prime(
+        self, channel_id: int, messages: list[tuple[int, str]], primed: bool = True
+    ):
+        """Merge fetched (message id, line) pairs into the buffer, newest kept."""
+        buffer = self._buffer(channel_id)
+        entries = {entry[0]: entry for entry in buffer}
+        for message_id, line in messages:
+            entries.setdefault(message_id, [message_id, line, None])
+        buffer.clear()
+        buffer.extend(entries[message_id] for message_id in sorted(entries))
+        if primed:
+            self._primed.add(channel_id)
+
+    def before(self, channel_id: int, message_id: int):
+        """Yield (line, tokens) for messages older than message_id, newest first."""
+        for entry in reversed(list(self._channels.get(channel_id, ()))):
+            if entry[0] >= message_id:
+                continue
+            if entry[2] is None:
+                entry[2] = self.count_tokens(entry[1])
+            yield entry[1], entry[2]
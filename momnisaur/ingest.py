@@ -0,0 +1,183 @@
+import asyncio
+import json
+import os
+import random
+import re
+
+import aiohttp
+
+EMBERWIND_KEY = os.getenv("EMBERWIND_KEY")
+EMBERWIND_EMAIL = os.getenv("EMBERWIND_EMAIL")
+EMBERWIND_PASSWORD = os.getenv("EMBERWIND_PASSWORD")
+# Point this at a local stub server to exercise ingestion without the live site.
+API_URL: str = os.getenv(
+    "EMBERWIND_API_URL", "https://emberwindgame.com/emberwind-web/api/v1/web"
+)
+
+MAX_CONNECTIONS: int = 8
+# Timeouts cover connecting and each read, not the wait for a pooled connection, so
+# requests queued behind MAX_CONNECTIONS others do not time out before they start.
+CONNECT_TIMEOUT: float = 10.0
+READ_TIMEOUT: float = 30.0
+RETRIES: int = 4
+BACKOFF: float = 0.5
+RETRY_STATUSES: set[int] = {429, 500, 502, 503, 504}
+
+CLEAN_HTML: re.Pattern = re.compile(r"<.*?>")
+
+CLASSES: list[str] = [
+    "archer",
+    "ardent",
+    "atlanta",
+    "druid",
+    "invoker",
+    "rogue",
+    "spiritualist",
+    "tactician",
+    "warrior",
+]
+
+SUBCLASSES: list[str] = [
+    "elysian_legionnaire",
+    "hekau",
+    "nightshade",
+    "saviour",
+    "wildfang",
+]
+
+
+def session() -> aiohttp.ClientSession:
+    """Return a session whose connection pool bounds how many requests run at once."""
+    return aiohttp.ClientSession(
+        headers={"Emberwind-Api-Key": EMBERWIND_KEY} if EMBERWIND_KEY else None,
+        connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS),
+        timeout=aiohttp.ClientTimeout(
+            total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+        ),
+    )
+
+
+async def fetch_json(session: aiohttp.ClientSession, url: str, **kwargs):
+    """GET url as JSON, retrying rate limits, server errors and timeouts."""
+    for attempt in range(RETRIES):
+        try:
+            async with session.get(url, **kwargs) as resp:
+                if resp.status in RETRY_STATUSES and attempt < RETRIES - 1:
+                    print(f"Retrying {url} after HTTP {resp.status}")
+                else:
+                    resp.raise_for_status()
+                    return await resp.json()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == RETRIES - 1:
+                raise
+            print(f"Retrying {url} after {type(e).__name__}")
+        await asyncio.sleep(BACKOFF * 2**attempt + random.uniform(0, BACKOFF))
+
+
+def clean(text: str) -> str:
+    return (
+        re.sub(CLEAN_HTML, " ", text)
+        .replace("#", "")
+        .replace("@", "")
+        .replace("$", "")
+        .strip()
+    )
+
+
+def format_faq(question: dict) -> str:
+    return clean(
+        f"{' '.join(x['name'] for x in question['path'])}\n"
+        f"{question['question']}\n"
+        f"{question['answer']}"
+    )
+
+
+def format_actions(tiers: list[dict], class_name: str) -> list[str]:
+    """Format the traits, class actions and tide turners of every tier for one class."""
+    documents = []
+    for tier in tiers:
+        for action, category in [
+            *[(t, "Trait") for t in tier["traits"]],
+            *[(a, "Class Action") for a in tier["actions"]],
+            *[(t, "Tide Turner Action") for t in tier["tideTurnerActions"]],
+        ]:
+            name = action.get("name", "")
+            type = action.get("type", "")
+            subtype = action.get("subtype", "")
+            target = action.get("target", "")
+            range_description = action.get("rangeDescription", "")
+            action_range = action.get("range", "")
+            action_speed = action.get("actionSpeed", "")
+            effect = action.get("effect", "")
+
+            formatted = f"Class: {class_name.capitalize()}\n"
+            formatted += f"{category}: {name}\n"
+            if type == "Passive":
+                formatted += f"Type: {type}\n"
+            else:
+                formatted += f"Type: {type} / {subtype}\n"
+                formatted += f"Target: {target}\n"
+                if action_range:
+                    formatted += f"Range: {range_description} / {action_range}\n"
+                formatted += f"Speed: {action_speed}\n"
+            formatted += f"Effect: {effect}"
+
+            documents.append(clean(formatted))
+    return documents
+
+
+async def faq_documents(session: aiohttp.ClientSession):
+    """Yield every formatted FAQ entry in index order, fetched concurrently."""
+    url = f"{API_URL}/content/faq"
+    index = await fetch_json(session, url, params={"page": 0, "size": 1000})
+    tasks = [
+        asyncio.create_task(fetch_json(session, f"{url}/{faq['slug']}"))
+        for faq in index["data"]
+    ]
+    try:
+        for task in tasks:
+            yield format_faq(await task)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def login(session: aiohttp.ClientSession) -> bool:
+    body = json.dumps(
+        {
+            "email": EMBERWIND_EMAIL,
+            "password": EMBERWIND_PASSWORD,
+            "rememberMe": False,
+        }
+    )
+    async with session.post(
+        f"{API_URL}/auth/login",
+        data=body,
+        headers={"Content-Type": "application/json", "Accept": "*/*"},
+    ) as resp:
+        return resp.status == 200
+
+
+async def hero_action_documents(session: aiohttp.ClientSession):
+    """Yield every formatted class and subclass action, fetched concurrently.
+
+    The session must already be logged in.
+    """
+    urls = {
+        **{name: f"{API_URL}/heroes/hero-creator/classes/{name}" for name in CLASSES},
+        **{
+            name: f"{API_URL}/heroes/hero-creator/subclasses/{name}"
+            for name in SUBCLASSES
+        },
+    }
+    tasks = {
+        name: asyncio.create_task(fetch_json(session, f"{url}/options/up-to-tier/4"))
+        for name, url in urls.items()
+    }
+    try:
+        for name, task in tasks.items():
+            for document in format_actions(await task, name):
+                yield document
+    finally:
+        for task in tasks.values():
+            task.cancel()
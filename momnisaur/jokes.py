@@ -0,0 +1,88 @@
+import json
+import os
+import random
+
+from momnisaur.storage import atomic_write
+
+
+class JokePool:
+    """Bounded pool of pre-generated jokes, spread evenly across a list of topics.
+
+    Jokes are taken from a random topic that has one, and refills go to whichever topic
+    has the fewest, so the pool never fills up with jokes about one thing.
+    """
+
+    def __init__(self, topics: list[str], maxsize: int = 100):
+        self.maxsize = maxsize
+        self.per_topic = max(1, -(-maxsize // len(topics)))
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self._jokes: dict[str, list[str]] = {topic: [] for topic in topics}
+
+    def __len__(self) -> int:
+        return sum(len(jokes) for jokes in self._jokes.values())
+
+    def take(self) -> str | None:
+        """Remove and return a random joke, or None if the pool is empty."""
+        topics = [topic for topic, jokes in self._jokes.items() if jokes]
+        if not topics:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._jokes[random.choice(topics)].pop()
+
+    def wanted(self) -> str | None:
+        """Return the topic of the next joke to generate, or None if full."""
+        if len(self) >= self.maxsize:
+            return None
+        fewest = min(len(jokes) for jokes in self._jokes.values())
+        if fewest >= self.per_topic:
+            return None
+        return random.choice(
+            [topic for topic, jokes in self._jokes.items() if len(jokes) == fewest]
+        )
+
+    def add(self, topic: str, joke: str) -> bool:
+        """Add a joke about topic, or return False if it is a repeat or full."""
+        jokes = self._jokes.get(topic)
+        if jokes is None or len(jokes) >= self.per_topic or len(self) >= self.maxsize:
+            return False
+        if any(joke in other for other in self._jokes.values()):
+            return False
+        jokes.append(joke)
+        self.generated += 1
+        return True
+
+    def stats(self) -> str:
+        return (
+            f"{len(self)}/{self.maxsize} jokes, {self.hits} served from the pool, "
+            f"{self.misses} misses, {self.generated} generated"
+        )
+
+    def save(self, path: str):
+        """Write the pooled jokes to a JSON file atomically."""
+        with atomic_write(path) as file:
+            json.dump(self._jokes, file)
+
+    def load(self, path: str):
+        """Restore jokes saved by save, dropping topics no longer in the list.
+
+        An unreadable file is treated as an empty pool.
+        """
+        if not os.path.isfile(path):
+            return
+        try:
+            with open(path, encoding="utf8") as file:
+                saved = json.load(file)
+            jokes = [
+                (str(topic), str(joke))
+                for topic, jokes in saved.items()
+                for joke in jokes
+            ]
+        except (OSError, ValueError, AttributeError, TypeError) as e:
+            print(f"Ignoring unreadable dad jokes {path}: {e!r}")
+            return
+        for topic, joke in jokes:
+            self.add(topic, joke)
+        self.generated = 0
@@ -0,0 +1,495 @@
+import ast
+import glob
+import hashlib
+import json
+import os
+import time
+import weakref
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from momnisaur.lexical import BM25Index, Postings
+from momnisaur.storage import atomic_write, load_npz
+
+# pandas is imported where frames are built, so importing this module stays cheap.
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+def normalize(embeddings) -> np.ndarray:
+    """Return embeddings as a contiguous float32 matrix with unit-length rows."""
+    matrix = np.array(embeddings, dtype=np.float32)
+    if matrix.ndim != 2:
+        matrix = (
+            matrix.reshape(len(matrix), -1) if matrix.size else matrix.reshape(0, 0)
+        )
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    matrix /= norms
+    return np.ascontiguousarray(matrix)
+
+
+# Segments with at least ANN_MIN_ROWS rows get an IVF index; smaller ones are scanned
+# exactly. ANN_NPROBE is the recall/speed knob: how many of the nearest lists a query
+# scans.
+ANN_MIN_ROWS: int = 4096
+ANN_NPROBE: int = 8
+
+
+class IVFIndex:
+    """Inverted-file index bucketing rows by their nearest spherical k-means centroid.
+
+    Rows of list i are order[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @staticmethod
+    def assign(
+        matrix: np.ndarray, centroids: np.ndarray, chunk: int = 8192
+    ) -> np.ndarray:
+        return np.concatenate(
+            [
+                np.argmax(matrix[i : i + chunk] @ centroids.T, axis=1)
+                for i in range(0, len(matrix), chunk)
+            ]
+        )
+
+    @classmethod
+    def build(
+        cls,
+        matrix: np.ndarray,
+        lists: int | None = None,
+        iterations: int = 8,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """Cluster the normalized rows of matrix into about sqrt(len(matrix)) lists."""
+        lists = min(lists or int(np.sqrt(len(matrix))), len(matrix))
+        rng = np.random.default_rng(seed)
+        centroids = np.array(matrix[rng.choice(len(matrix), lists, replace=False)])
+        for _ in range(iterations):
+            assignment = cls.assign(matrix, centroids)
+            order = np.argsort(assignment, kind="stable")
+            counts = np.bincount(assignment, minlength=lists)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            filled = counts > 0
+            sums = np.add.reduceat(matrix[order], starts[filled], axis=0)
+            centroids[filled] = normalize(sums)
+        assignment = cls.assign(matrix, centroids)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(assignment, minlength=lists)))
+        )
+        return cls(centroids, order, offsets)
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """Return the sorted rows of the nprobe lists nearest to query."""
+        scores = self.centroids @ query
+        if nprobe < len(scores):
+            lists = np.argpartition(scores, -nprobe)[-nprobe:]
+        else:
+            lists = np.arange(len(scores))
+        return np.sort(
+            np.concatenate(
+                [self.order[self.offsets[i] : self.offsets[i + 1]] for i in lists]
+            )
+        )
+
+    def save(self, path: str, vectors: str):
+        """Save the index along with the name of the vectors file it was built from."""
+        with atomic_write(path, "wb") as file:
+            np.savez(
+                file,
+                centroids=self.centroids,
+                order=self.order,
+                offsets=self.offsets,
+                vectors=np.array(vectors),
+            )
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    @classmethod
+    def load(cls, path: str, vectors: str, rows: int) -> "IVFIndex | None":
+        """Load a saved index, or None if missing, unreadable or for other vectors.
+
+        An index may cover fewer than rows rows, since appends go to the same vectors
+        file.
+        """
+        saved = load_npz(path, "centroids", "order", "offsets", "vectors")
+        if (
+            saved is None
+            or str(saved["vectors"]) != vectors
+            or len(saved["order"]) > rows
+        ):
+            return None
+        return cls(saved["centroids"], saved["order"], saved["offsets"])
+
+
+class EmbeddingIndex:
+    """Row-normalized float32 segments, each searched with one matrix-vector product.
+
+    Segments are kept separate so memory-mapped stores can be searched without copying
+    them into one matrix; row positions run across the segments in order. A segment with
+    an IVF index only scores the rows in its nprobe nearest lists.
+    """
+
+    def __init__(self, matrices: list[np.ndarray], ivfs: list | None = None):
+        ivfs = ivfs or [None] * len(matrices)
+        segments = [(m, ivf) for m, ivf in zip(matrices, ivfs) if len(m)]
+        self.matrices: list[np.ndarray] = [m for m, _ in segments]
+        self.ivfs: list[IVFIndex | None] = [ivf for _, ivf in segments]
+        self.nprobe: int = ANN_NPROBE
+
+    def __len__(self) -> int:
+        return sum(len(m) for m in self.matrices)
+
+    @classmethod
+    def from_embeddings(cls, embeddings) -> "EmbeddingIndex":
+        return cls([normalize(embeddings)])
+
+    @classmethod
+    def from_frame(cls, df: "pd.DataFrame") -> "EmbeddingIndex":
+        return cls.from_embeddings(df["embedding"].tolist())
+
+    def vectors(self):
+        """Yield every normalized row in position order."""
+        for matrix in self.matrices:
+            yield from matrix
+
+    def take(self, rows) -> np.ndarray:
+        """Return the normalized vectors at the given row positions, in that order."""
+        rows = np.asarray(rows, dtype=np.intp)
+        starts = np.cumsum([0] + [len(m) for m in self.matrices])
+        segments = np.searchsorted(starts, rows, side="right") - 1
+        vectors = np.empty(
+            (len(rows), self.matrices[0].shape[1] if self.matrices else 0)
+        )
+        for segment, matrix in enumerate(self.matrices):
+            chosen = segments == segment
+            if chosen.any():
+                vectors[chosen] = matrix[rows[chosen] - starts[segment]]
+        return vectors.astype(np.float32)
+
+    def search(
+        self, query_embedding, top_n: int, exact: bool = False
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return positions and cosine similarities of the top_n rows, best first."""
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        all_rows = []
+        all_scores = []
+        offset = 0
+        for matrix, ivf in zip(self.matrices, self.ivfs):
+            if ivf is None or exact:
+                all_rows.append(np.arange(offset, offset + len(matrix)))
+                all_scores.append(matrix @ query)
+            else:
+                candidates = ivf.candidates(query, self.nprobe)
+                all_rows.append(candidates + offset)
+                all_scores.append(matrix[candidates] @ query)
+            offset += len(matrix)
+        if not all_rows:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        rows = np.concatenate(all_rows)
+        scores = np.concatenate(all_scores)
+
+        top_n = min(top_n, len(scores))
+        if top_n <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        if top_n < len(scores):
+            best = np.argpartition(scores, -top_n)[-top_n:]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return rows[best], scores[best]
+
+
+_indexes: dict[int, tuple[weakref.ref, EmbeddingIndex]] = {}
+_lexical_indexes: dict[int, tuple[weakref.ref, BM25Index]] = {}
+
+
+def _register(registry: dict, df: "pd.DataFrame", index):
+    key = id(df)
+    registry[key] = (weakref.ref(df, lambda _, key=key: registry.pop(key, None)), index)
+
+
+def _registered(registry: dict, df: "pd.DataFrame"):
+    entry = registry.get(id(df))
+    if entry is not None and entry[0]() is df:
+        return entry[1]
+    return None
+
+
+def register_index(
+    df: "pd.DataFrame", index: EmbeddingIndex, lexical: BM25Index | None = None
+):
+    """Attach prebuilt indexes to a frame for as long as the frame is alive."""
+    _register(_indexes, df, index)
+    if lexical is not None:
+        _register(_lexical_indexes, df, lexical)
+
+
+def index_for(df: "pd.DataFrame") -> EmbeddingIndex:
+    """Return the index registered for df, building it from the embeddings if needed."""
+    index = _registered(_indexes, df)
+    if index is None:
+        index = EmbeddingIndex.from_frame(df)
+        _register(_indexes, df, index)
+    return index
+
+
+def lexical_index_for(df: "pd.DataFrame") -> BM25Index:
+    """Return the BM25 index registered for df, building it from the text if needed."""
+    lexical = _registered(_lexical_indexes, df)
+    if lexical is None:
+        lexical = BM25Index(Postings.from_texts(df["text"]))
+        _register(_lexical_indexes, df, lexical)
+    return lexical
+
+
+def rows_frame(rows: list[dict], source: str, count_tokens=None) -> "pd.DataFrame":
+    """Return the text, token count and source of rows as a frame."""
+    import pandas as pd
+
+    return pd.DataFrame(
+        {
+            "text": [row["text"] for row in rows],
+            "tokens": [
+                row.get("tokens") or (count_tokens(row["text"]) if count_tokens else 0)
+                for row in rows
+            ],
+            "source": source,
+        },
+        columns=["text", "tokens", "source"],
+    )
+
+
+class Partition:
+    """The rows of one knowledge base source and the vector segments that match them."""
+
+    def __init__(
+        self,
+        source: str,
+        frame: "pd.DataFrame",
+        matrices: list[np.ndarray],
+        ivfs: list | None = None,
+        postings: Postings | None = None,
+    ):
+        self.source = source
+        self.frame = frame
+        self.matrices = matrices
+        self.ivfs: list[IVFIndex | None] = ivfs or [None] * len(matrices)
+        self.postings: Postings = (
+            Postings.from_texts(frame["text"]) if postings is None else postings
+        )
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    @classmethod
+    def from_store(cls, source: str, prefix: str, count_tokens=None) -> "Partition":
+        """Load the store at prefix, with an IVF index if it is large enough.
+
+        Rows appended since the index was built are scanned exactly, as their own
+        segment, until there are ANN_MIN_ROWS of them and the index is rebuilt.
+        """
+        rows, matrix = load_store(prefix)
+        frame = rows_frame(rows, source, count_tokens)
+        if not len(matrix):
+            return cls(source, frame, [matrix])
+
+        vectors = os.path.basename(matrix.filename)
+        postings = Postings.load(f"{prefix}.bm25.npz", vectors, len(rows))
+        if postings is None or len(postings) < len(rows):
+            tail = rows[len(postings) if postings else 0 :]
+            postings = Postings.concat(
+                [
+                    *([postings] if postings else []),
+                    Postings.from_texts(r["text"] for r in tail),
+                ]
+            )
+            postings.save(f"{prefix}.bm25.npz", vectors)
+        if len(matrix) < ANN_MIN_ROWS:
+            return cls(source, frame, [matrix], postings=postings)
+
+        ivf = IVFIndex.load(f"{prefix}.ivf.npz", vectors, len(matrix))
+        if ivf is None or len(matrix) - len(ivf) >= ANN_MIN_ROWS:
+            print(f"Building IVF index for {source}")
+            ivf = IVFIndex.build(matrix)
+            ivf.save(f"{prefix}.ivf.npz", vectors)
+        return cls(
+            source,
+            frame,
+            [matrix[: len(ivf)], matrix[len(ivf) :]],
+            [ivf, None],
+            postings,
+        )
+
+    def extend(self, rows: list[dict], embeddings) -> "Partition":
+        """Return a copy of this partition with rows appended as a new segment."""
+        import pandas as pd
+
+        frame = rows_frame(rows, self.source)
+        if len(self.frame):
+            frame = pd.concat([self.frame, frame], ignore_index=True)
+        return Partition(
+            self.source,
+            frame,
+            [*self.matrices, normalize(embeddings)],
+            [*self.ivfs, None],
+            Postings.concat(
+                [self.postings, Postings.from_texts(r["text"] for r in rows)]
+            ),
+        )
+
+
+class KnowledgeBase:
+    """An immutable snapshot of every partition with their combined frame and index.
+
+    Replacing a partition builds a new snapshot, so a query holding the old frame keeps
+    searching a consistent set of rows and vectors.
+    """
+
+    def __init__(self, partitions: dict[str, Partition] | None = None):
+        import pandas as pd
+
+        self.partitions: dict[str, Partition] = dict(partitions or {})
+        frames = [p.frame for p in self.partitions.values() if len(p)]
+        self.frame: "pd.DataFrame" = (
+            pd.concat(frames, ignore_index=True) if frames else rows_frame([], "")
+        )
+        self.index = EmbeddingIndex(
+            [m for p in self.partitions.values() for m in p.matrices],
+            [ivf for p in self.partitions.values() for ivf in p.ivfs],
+        )
+        self.lexical = BM25Index(
+            Postings.concat([p.postings for p in self.partitions.values() if len(p)])
+        )
+        register_index(self.frame, self.index, self.lexical)
+
+    def replace(self, *partitions: Partition) -> "KnowledgeBase":
+        return KnowledgeBase({**self.partitions, **{p.source: p for p in partitions}})
+
+
+# A store is two files sharing a prefix: "<prefix>.jsonl" holds a header line followed
+# by one JSON object per row, and the header names a raw float32 file holding the
+# normalized rows. Every save writes a new vectors file so a live memory map of the old
+# one is never replaced.
+
+
+def store_exists(prefix: str) -> bool:
+    return os.path.isfile(f"{prefix}.jsonl")
+
+
+def save_store(prefix: str, rows: list[dict], embeddings):
+    """Write rows and their embeddings to the store at prefix, replacing it."""
+    matrix = normalize(embeddings)
+    if len(matrix) != len(rows):
+        raise ValueError(f"{len(rows)} rows but {len(matrix)} embeddings")
+    vectors = f"{os.path.basename(prefix)}.{time.time_ns()}.f32"
+    matrix.tofile(os.path.join(os.path.dirname(prefix), vectors))
+
+    header = {"vectors": vectors, "dim": matrix.shape[1] if matrix.ndim == 2 else 0}
+    with atomic_write(f"{prefix}.jsonl") as file:
+        file.write(json.dumps(header) + "\n")
+        for row in rows:
+            file.write(json.dumps(row) + "\n")
+
+    for stale in glob.glob(f"{glob.escape(prefix)}.*.f32"):
+        if os.path.basename(stale) != vectors:
+            try:
+                os.remove(stale)
+            except OSError:
+                # Still mapped by a live index on Windows; the next save retries.
+                pass
+
+
+def append_store(prefix: str, rows: list[dict], embeddings):
+    """Append rows and their embeddings to the store at prefix without rewriting it."""
+    stored_rows = 0
+    if store_exists(prefix):
+        with open(f"{prefix}.jsonl", "r", encoding="utf8") as file:
+            header = json.loads(file.readline())
+            stored_rows = sum(1 for line in file if line.strip())
+    if not stored_rows:
+        save_store(prefix, rows, embeddings)
+        return
+
+    matrix = normalize(embeddings)
+    if matrix.shape[1] != header["dim"]:
+        raise ValueError(f"Expected {header['dim']} dimensions, got {matrix.shape[1]}")
+    # Write where the stored rows end so the tail of a torn earlier append is
+    # overwritten.
+    with open(os.path.join(os.path.dirname(prefix), header["vectors"]), "r+b") as file:
+        file.seek(stored_rows * header["dim"] * 4)
+        file.write(matrix.tobytes())
+    with open(f"{prefix}.jsonl", "a", encoding="utf8") as file:
+        for row in rows:
+            file.write(json.dumps(row) + "\n")
+
+
+def load_store(prefix: str) -> tuple[list[dict], np.ndarray]:
+    """Return the rows of the store at prefix and a read-only map of its vectors."""
+    with open(f"{prefix}.jsonl", "r", encoding="utf8") as file:
+        header = json.loads(file.readline())
+        rows = [json.loads(line) for line in file if line.strip()]
+    if not rows:
+        return rows, np.empty((0, header["dim"]), dtype=np.float32)
+    matrix = np.memmap(
+        os.path.join(os.path.dirname(prefix), header["vectors"]),
+        dtype=np.float32,
+        mode="r",
+        shape=(len(rows), header["dim"]),
+    )
+    return rows, matrix
+
+
+def content_hash(text: str, model: str) -> str:
+    """Hash the whitespace-normalized text together with the model that embeds it."""
+    normalized = " ".join(text.split())
+    return hashlib.sha256(f"{model}\0{normalized}".encode("utf8")).hexdigest()
+
+
+def row_hash(row: dict, model: str) -> str:
+    return row.get("hash") or content_hash(row["text"], model)
+
+
+def stored_embeddings(prefixes, model: str) -> dict[str, np.ndarray]:
+    """Map the content hash of every row in the given stores to its stored vector."""
+    known = {}
+    for prefix in prefixes:
+        if store_exists(prefix):
+            rows, matrix = load_store(prefix)
+            for row, vector in zip(rows, matrix):
+                known[row_hash(row, model)] = vector
+    return known
+
+
+def migrate_csv(csv_path: str, prefix: str, count_tokens=None):
+    """Convert a legacy text/embedding CSV into a store at prefix.
+
+    When count_tokens is given, each row also records the token count of its text.
+    """
+    import pandas as pd
+
+    df = pd.read_csv(csv_path)
+    save_store(
+        prefix,
+        [
+            (
+                {"text": text, "tokens": count_tokens(text)}
+                if count_tokens
+                else {"text": text}
+            )
+            for text in df["text"]
+        ],
+        [ast.literal_eval(embedding) for embedding in df["embedding"]],
+    )
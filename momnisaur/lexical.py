@@ -0,0 +1,189 @@
+import math
+import re
+
+import numpy as np
+
+from momnisaur.storage import atomic_write, load_npz
+
+WORD: re.Pattern = re.compile(r"[a-z0-9]+(?:['-][a-z0-9]+)*")
+
+BM25_K1: float = 1.5
+BM25_B: float = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    return WORD.findall(text.lower())
+
+
+class Postings:
+    """Term counts of a run of documents, kept per partition and merged for BM25."""
+
+    def __init__(
+        self,
+        terms: list[str],
+        term_ids: np.ndarray,
+        doc_ids: np.ndarray,
+        counts: np.ndarray,
+        lengths: np.ndarray,
+    ):
+        self.terms = terms
+        self.term_ids = term_ids
+        self.doc_ids = doc_ids
+        self.counts = counts
+        self.lengths = lengths
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    @classmethod
+    def from_texts(cls, texts) -> "Postings":
+        vocabulary: dict[str, int] = {}
+        tokens, lengths = [], []
+        for text in texts:
+            ids = [vocabulary.setdefault(t, len(vocabulary)) for t in tokenize(text)]
+            tokens.extend(ids)
+            lengths.append(len(ids))
+        # Count each (document, term) pair with one sort instead of a Counter per
+        # document.
+        width = max(len(vocabulary), 1)
+        docs = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+        keys, counts = np.unique(
+            docs * width + np.array(tokens, dtype=np.int64), return_counts=True
+        )
+        return cls(
+            list(vocabulary),
+            (keys % width).astype(np.int32),
+            (keys // width).astype(np.int32),
+            counts.astype(np.float32),
+            np.array(lengths, dtype=np.float32),
+        )
+
+    def save(self, path: str, vectors: str):
+        """Save the postings with the name of the vectors file their rows match."""
+        with atomic_write(path, "wb") as file:
+            np.savez(
+                file,
+                terms=np.array(self.terms, dtype=str),
+                term_ids=self.term_ids,
+                doc_ids=self.doc_ids,
+                counts=self.counts,
+                lengths=self.lengths,
+                vectors=np.array(vectors),
+            )
+
+    @classmethod
+    def load(cls, path: str, vectors: str, rows: int) -> "Postings | None":
+        """Load saved postings, or None if missing, unreadable or for other rows.
+
+        The postings may cover fewer than rows rows, since appends go to the same store.
+        """
+        saved = load_npz(
+            path, "terms", "term_ids", "doc_ids", "counts", "lengths", "vectors"
+        )
+        if (
+            saved is None
+            or str(saved["vectors"]) != vectors
+            or len(saved["lengths"]) > rows
+        ):
+            return None
+        return cls(
+            saved["terms"].tolist(),
+            saved["term_ids"],
+            saved["doc_ids"],
+            saved["counts"],
+            saved["lengths"],
+        )
+
+    @classmethod
+    def concat(cls, parts: list["Postings"]) -> "Postings":
+        """Join postings end to end, numbering documents across them in order."""
+        vocabulary: dict[str, int] = {}
+        term_ids, doc_ids = [], []
+        offset = 0
+        for part in parts:
+            mapping = np.array(
+                [vocabulary.setdefault(term, len(vocabulary)) for term in part.terms],
+                dtype=np.int32,
+            )
+            term_ids.append(mapping[part.term_ids] if len(mapping) else part.term_ids)
+            doc_ids.append(part.doc_ids + offset)
+            offset += len(part)
+        return cls(
+            list(vocabulary),
+            np.concatenate(term_ids or [np.empty(0, np.int32)]),
+            np.concatenate(doc_ids or [np.empty(0, np.int32)]),
+            np.concatenate([p.counts for p in parts] or [np.empty(0, np.float32)]),
+            np.concatenate([p.lengths for p in parts] or [np.empty(0, np.float32)]),
+        )
+
+
+class BM25Index:
+    """Okapi BM25 over an inverted index, with posting weights computed up front."""
+
+    def __init__(self, postings: Postings, k1: float = BM25_K1, b: float = BM25_B):
+        self.vocabulary: dict[str, int] = {t: i for i, t in enumerate(postings.terms)}
+        self.documents = len(postings)
+        self.k1 = k1
+        order = np.argsort(postings.term_ids, kind="stable")
+        term_ids = postings.term_ids[order]
+        self.doc_ids: np.ndarray = postings.doc_ids[order]
+        self.offsets: np.ndarray = np.searchsorted(
+            term_ids, np.arange(len(self.vocabulary) + 1)
+        )
+
+        frequencies = np.diff(self.offsets)
+        self.idf: np.ndarray = np.log(
+            1 + (self.documents - frequencies + 0.5) / (frequencies + 0.5)
+        ).astype(np.float32)
+        counts = postings.counts[order]
+        average = postings.lengths.mean() if self.documents else 1.0
+        norms = k1 * (1 - b + b * postings.lengths[self.doc_ids] / max(average, 1.0))
+        self.weights: np.ndarray = (
+            self.idf[term_ids] * counts * (k1 + 1) / (counts + norms)
+        ).astype(np.float32)
+
+    def __len__(self) -> int:
+        return self.documents
+
+    def query_terms(self, query: str) -> list[int]:
+        return list(
+            dict.fromkeys(
+                self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary
+            )
+        )
+
+    def search(self, query: str, top_n: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return the positions and scores of the top_n matching rows, best first."""
+        scores = np.zeros(self.documents, dtype=np.float32)
+        for term in self.query_terms(query):
+            postings = slice(self.offsets[term], self.offsets[term + 1])
+            scores[self.doc_ids[postings]] += self.weights[postings]
+        matches = np.flatnonzero(scores)
+        if len(matches) > top_n:
+            matches = matches[np.argpartition(scores[matches], -top_n)[-top_n:]]
+        matches = matches[np.argsort(-scores[matches], kind="stable")]
+        return matches, scores[matches]
+
+    def confidence(self, query: str, best_score: float) -> float:
+        """Best score as a fraction of the most the query's terms could score, 0 to 1.
+
+        A row holding every term once at the average length scores 1 / (k1 + 1). Returns
+        0 unless the query has a rare term, one found in at most 2% of the rows.
+        """
+        idf = [self.idf[t] for t in self.query_terms(query)]
+        if not idf or max(idf) < self.rare_idf():
+            return 0.0
+        return float(best_score / ((self.k1 + 1) * sum(idf)))
+
+    def rare_idf(self, rare_fraction: float = 0.02) -> float:
+        frequency = max(1.0, rare_fraction * self.documents)
+        return math.log(1 + (self.documents - frequency + 0.5) / (frequency + 0.5))
+
+
+def fuse(rankings: list[np.ndarray], k: int = 60) -> np.ndarray:
+    """Merge rankings of row positions by reciprocal rank fusion, best first."""
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking.tolist()):
+            scores[row] = scores.get(row, 0.0) + 1 / (k + rank + 1)
+    return np.array(sorted(scores, key=scores.get, reverse=True), dtype=np.intp)
@@ -0,0 +1,186 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import time
+
+from momnisaur.storage import atomic_write
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS: tuple[float, ...] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+_handler: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "handler", default="none"
+)
+
+
+class Histogram:
+    """Cumulative-bucket histogram of observations, as Prometheus exposes them."""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating inside the bucket that holds it."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+
+def _series(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+class Metrics:
+    """Stage timings grouped by handler, plus gauges read when the metrics are rendered.
+
+    handler() times a whole event or command and names it for every span() timed inside
+    it, including spans in tasks it starts.
+    """
+
+    def __init__(self, prefix: str = "momnisaur"):
+        self.prefix = prefix
+        self.stages: dict[tuple[str, str], Histogram] = {}
+        self.errors: dict[tuple[str, str], int] = {}
+        self.loop_lag = Histogram()
+        self.gauges: dict[str, tuple[str, callable]] = {}
+
+    def observe(self, stage: str, seconds: float, handler: str | None = None):
+        key = (handler or _handler.get(), stage)
+        histogram = self.stages.get(key)
+        if histogram is None:
+            histogram = self.stages[key] = Histogram()
+        histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            key = (_handler.get(), stage)
+            self.errors[key] = self.errors.get(key, 0) + 1
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def handler(self, name: str):
+        token = _handler.set(name)
+        try:
+            with self.span("total"):
+                yield
+        finally:
+            _handler.reset(token)
+
+    def gauge(self, name: str, description: str, read):
+        """Register a gauge whose value is read from a callable when rendered."""
+        self.gauges[name] = (description, read)
+
+    async def watch_event_loop(self, interval: float = 0.5):
+        """Record how late the loop wakes from a sleep of interval, until cancelled."""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(0.0, time.perf_counter() - start - interval))
+
+    def _histogram_lines(self, name: str, labels: dict[str, str], histogram: Histogram):
+        cumulative = 0
+        for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+            cumulative += count
+            yield f"{_series(f'{name}_bucket', {**labels, 'le': bound})} {cumulative}"
+        yield f"{_series(f'{name}_sum', labels)} {histogram.sum}"
+        yield f"{_series(f'{name}_count', labels)} {histogram.count}"
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        name = f"{self.prefix}_stage_seconds"
+        lines = [
+            f"# HELP {name} Time spent in each stage of a handler.",
+            f"# TYPE {name} histogram",
+        ]
+        for (handler, stage), histogram in sorted(self.stages.items()):
+            lines += self._histogram_lines(
+                name, {"handler": handler, "stage": stage}, histogram
+            )
+
+        name = f"{self.prefix}_stage_errors_total"
+        lines += [
+            f"# HELP {name} Stages that ended with an exception.",
+            f"# TYPE {name} counter",
+        ]
+        for (handler, stage), count in sorted(self.errors.items()):
+            lines.append(
+                f"{_series(name, {'handler': handler, 'stage': stage})} {count}"
+            )
+
+        name = f"{self.prefix}_event_loop_lag_seconds"
+        lines += [
+            f"# HELP {name} How late the event loop wakes from a timed sleep.",
+            f"# TYPE {name} histogram",
+            *self._histogram_lines(name, {}, self.loop_lag),
+        ]
+
+        for gauge, (description, read) in self.gauges.items():
+            name = f"{self.prefix}_{gauge}"
+            lines += [
+                f"# HELP {name} {description}",
+                f"# TYPE {name} gauge",
+                f"{name} {read()}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Write render() to path atomically, for a node exporter textfile collector."""
+        with atomic_write(path) as file:
+            file.write(self.render())
+
+    def summary(self) -> str:
+        """Return a short table of stage latencies for reading in Discord."""
+        lines = [f"{'handler/stage':<32} {'count':>6} {'p50':>7} {'p99':>7} {'max':>7}"]
+        for (handler, stage), histogram in sorted(self.stages.items()):
+            lines.append(
+                f"{handler + '/' + stage:<32} {histogram.count:>6} "
+                f"{histogram.quantile(0.5):>7.3f} {histogram.quantile(0.99):>7.3f} "
+                f"{histogram.max:>7.3f}"
+            )
+        lines.append(
+            f"event loop lag p99 {self.loop_lag.quantile(0.99):.3f}s "
+            f"max {self.loop_lag.max:.3f}s"
+        )
+        lines += [f"{gauge}: {read()}" for gauge, (_, read) in self.gauges.items()]
+        return "\n".join(lines)
@@ -0,0 +1,221 @@
+import functools
+import math
+import re
+
+import numpy as np
+
+from momnisaur.rolling import RollRejected
+
+# Largest number of distinct totals an expression may have.
+MAX_OUTCOMES: int = 1_000_000
+# Keep-highest/keep-lowest dice take about dice^2 / 2 * sides steps over keep * sides
+# totals.
+MAX_KEEP_DICE: int = 100
+MAX_KEEP_WORK: int = 200_000_000
+MAX_SIDES: int = 10_000
+# Above this many multiplications, convolve with an FFT instead of directly.
+DIRECT_CONVOLVE: int = 1_000_000
+
+TERM: re.Pattern = re.compile(
+    r"([+-])(?:(\d*)d(\d+|%)(?:(kh|kl|dh|dl|h|l|\^|v)(\d*))?|(\d+))"
+)
+
+
+class Distribution:
+    """Exact probabilities of the integer totals offset, offset + 1, ... of a roll."""
+
+    def __init__(self, offset: int, probabilities: np.ndarray):
+        self.offset = offset
+        self.probabilities = probabilities
+        self.probabilities.flags.writeable = False
+
+    @property
+    def minimum(self) -> int:
+        return self.offset
+
+    @property
+    def maximum(self) -> int:
+        return self.offset + len(self.probabilities) - 1
+
+    def totals(self) -> np.ndarray:
+        return np.arange(self.offset, self.offset + len(self.probabilities))
+
+    def mean(self) -> float:
+        return float(self.totals() @ self.probabilities)
+
+    def variance(self) -> float:
+        deviations = self.totals() - self.mean()
+        return float((deviations * deviations) @ self.probabilities)
+
+    def percentile(self, q: float) -> int:
+        """Return the smallest total that at least q of rolls come in at or under."""
+        cumulative = np.cumsum(self.probabilities)
+        return self.offset + int(np.searchsorted(cumulative, q - 1e-12))
+
+    def at_least(self, target: int) -> float:
+        start = min(max(target - self.offset, 0), len(self.probabilities))
+        return float(self.probabilities[start:].sum())
+
+    def __add__(self, other: "Distribution") -> "Distribution":
+        return Distribution(
+            self.offset + other.offset,
+            convolve(self.probabilities, other.probabilities),
+        )
+
+    def __neg__(self) -> "Distribution":
+        return Distribution(-self.maximum, self.probabilities[::-1].copy())
+
+
+def convolve(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    if len(a) * len(b) <= DIRECT_CONVOLVE:
+        return np.convolve(a, b)
+    size = len(a) + len(b) - 1
+    n = 1 << (size - 1).bit_length()
+    result = np.fft.irfft(np.fft.rfft(a, n) * np.fft.rfft(b, n), n)[:size]
+    # Rounding leaves tiny negative values where the true probability is zero.
+    np.clip(result, 0, None, out=result)
+    return result / result.sum()
+
+
+def constant(value: int) -> Distribution:
+    return Distribution(value, np.ones(1))
+
+
+def sum_of_dice(amount: int, sides: int) -> Distribution:
+    """Distribution of the total of amount dice, by repeated squaring of one die."""
+    result = constant(0)
+    power = Distribution(1, np.full(sides, 1 / sides))
+    while amount:
+        if amount & 1:
+            result = result + power
+        amount >>= 1
+        if amount:
+            power = power + power
+    return result
+
+
+def keep_highest(amount: int, sides: int, keep: int) -> Distribution:
+    """Distribution of the total of the highest keep of amount dice.
+
+    Faces are visited from highest to lowest. Given that the dice not yet placed are all
+    at most v, the number showing exactly v is binomial, and the first keep dice placed
+    are the kept ones.
+    """
+    keep = max(0, min(keep, amount))
+    # states[i] holds probabilities over kept totals with i dice placed so far.
+    states = [np.zeros(keep * sides + 1) for _ in range(amount + 1)]
+    states[0][0] = 1.0
+    for v in range(sides, 0, -1):
+        next_states = [np.zeros(keep * sides + 1) for _ in range(amount + 1)]
+        for placed, state in enumerate(states):
+            if not state.any():
+                continue
+            remaining = amount - placed
+            for count in range(remaining + 1):
+                if v == 1:
+                    if count != remaining:
+                        continue
+                    chance = 1.0
+                else:
+                    chance = (
+                        math.comb(remaining, count)
+                        * (1 / v) ** count
+                        * ((v - 1) / v) ** (remaining - count)
+                    )
+                if not chance:
+                    continue
+                shift = max(0, min(keep, placed + count) - placed) * v
+                if shift:
+                    next_states[placed + count][shift:] += chance * state[:-shift]
+                else:
+                    next_states[placed + count] += chance * state
+        states = next_states
+    # Totals below keep (or above keep * sides) cannot happen; drop them from the ends.
+    possible = np.flatnonzero(states[amount])
+    return Distribution(
+        int(possible[0]), states[amount][possible[0] : possible[-1] + 1].copy()
+    )
+
+
+def keep_lowest(amount: int, sides: int, keep: int) -> Distribution:
+    """Lowest keep of amount dice, as the highest of the dice read upside down."""
+    keep = max(0, min(keep, amount))
+    # A kept die showing x reads as sides + 1 - x upside down.
+    return -keep_highest(amount, sides, keep) + constant(keep * (sides + 1))
+
+
+def dice_term(amount: int, sides: int, mode: str | None, count: int) -> Distribution:
+    if sides < 1 or sides > MAX_SIDES:
+        raise RollRejected(f"dice need between 1 and {MAX_SIDES} sides")
+    if mode is None:
+        if amount * (sides - 1) + 1 > MAX_OUTCOMES:
+            raise RollRejected("too many possible totals")
+        return sum_of_dice(amount, sides)
+
+    if mode in ("dh", "dl"):
+        count = amount - count
+    count = max(0, min(count, amount))
+    if (
+        amount > MAX_KEEP_DICE
+        or amount**2 // 2 * sides * (count * sides + 1) > MAX_KEEP_WORK
+    ):
+        raise RollRejected("too many dice to keep or drop")
+    if mode in ("h", "^", "kh", "dl"):
+        return keep_highest(amount, sides, count)
+    return keep_lowest(amount, sides, count)
+
+
+def distribution(expression: str) -> Distribution:
+    """Return the exact distribution of a sum of dice terms and constants.
+
+    Dice terms are NdM, optionally followed by h/kh/^ or l/kl/v and how many to keep,
+    or dh/dl and how many to drop; d% is a d100. Raises RollRejected for anything else.
+    """
+    expression = expression.lower().replace(" ", "")
+    if expression[:1] not in ("+", "-"):
+        expression = "+" + expression
+    return compiled(expression)
+
+
+@functools.lru_cache(maxsize=256)
+def compiled(expression: str) -> Distribution:
+    result = constant(0)
+    position = 0
+    outcomes = 1
+    for match in TERM.finditer(expression):
+        if match.start() != position:
+            break
+        position = match.end()
+        sign, amount, sides, mode, count, value = match.groups()
+        if value is not None:
+            term = constant(int(value))
+        else:
+            amount = int(amount or 1)
+            sides = 100 if sides == "%" else int(sides)
+            term = dice_term(amount, sides, mode, int(count or 1))
+        term = -term if sign == "-" else term
+        outcomes += len(term.probabilities) - 1
+        if outcomes > MAX_OUTCOMES:
+            raise RollRejected("too many possible totals")
+        result = result + term
+    if position != len(expression) or position == 0:
+        raise RollRejected(
+            "odds only work for sums of dice like 3d6+2, 4d6h3 or 2d20kl1"
+        )
+    return result
+
+
+def describe(expression: str, target: int | None = None) -> str:
+    """Summarize the distribution of expression for a chat message."""
+    odds = distribution(expression)
+    lines = [
+        f"Mean {odds.mean():.2f}, standard deviation {math.sqrt(odds.variance()):.2f}, "
+        f"range {odds.minimum} to {odds.maximum}",
+        "Percentiles: "
+        + ", ".join(
+            f"{q:.0%} {odds.percentile(q)}" for q in (0.05, 0.25, 0.5, 0.75, 0.95)
+        ),
+    ]
+    if target is not None:
+        lines.append(f"Chance of {target} or more: {odds.at_least(target):.2%}")
+    return "\n".join(lines)
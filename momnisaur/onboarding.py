@@ -0,0 +1,32 @@
+import time
+from collections import OrderedDict
+
+
+class PendingMembers:
+    """Members who joined but have not finished onboarding, kept for ttl seconds."""
+
+    def __init__(self, ttl: float = 24 * 60 * 60):
+        self.ttl = ttl
+        self.expired = 0
+        # Member id to join time, oldest first.
+        self._joined: OrderedDict[int, float] = OrderedDict()
+
+    def __len__(self) -> int:
+        self.prune()
+        return len(self._joined)
+
+    def prune(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._joined and next(iter(self._joined.values())) < cutoff:
+            self._joined.popitem(last=False)
+            self.expired += 1
+
+    def add(self, member_id: int):
+        self.prune()
+        self._joined[member_id] = time.monotonic()
+        self._joined.move_to_end(member_id)
+
+    def pop(self, member_id: int) -> bool:
+        """Forget member_id, returning whether it was still pending."""
+        self.prune()
+        return self._joined.pop(member_id, None) is not None
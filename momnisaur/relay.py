@@ -0,0 +1,90 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+
+class SeenIds:
+    """Remembers the most recent maxsize ids, forgetting the oldest first."""
+
+    def __init__(self, maxsize: int = 10_000):
+        self.maxsize = maxsize
+        self._ids: OrderedDict[str, None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, item_id: str) -> bool:
+        """Record item_id, returning False if it was already seen."""
+        if item_id in self._ids:
+            self._ids.move_to_end(item_id)
+            return False
+        self._ids[item_id] = None
+        while len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+        return True
+
+
+class RelayQueue:
+    """Bounded queue of (line, created) pairs that drops the oldest line when full.
+
+    Lines are taken in digests: as many as fit in one message, after waiting a short
+    while for more to arrive.
+    """
+
+    def __init__(self, maxsize: int = 200, seen: int = 10_000):
+        self.seen = SeenIds(seen)
+        self.offered = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.sent = 0
+        self.digests = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._items: deque[tuple[str, float]] = deque(maxlen=maxsize)
+        self._ready = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def offer(self, item_id: str, line: str, created: float) -> bool:
+        """Queue line unless item_id was seen before. created is a Unix timestamp."""
+        self.offered += 1
+        if not self.seen.add(item_id):
+            self.duplicates += 1
+            return False
+        if len(self._items) == self._items.maxlen:
+            self.dropped += 1
+        self._items.append((line, created))
+        self._ready.set()
+        return True
+
+    async def digest(self, max_items: int, max_chars: int, wait: float) -> list[str]:
+        """Wait for a line, then up to wait seconds for a full digest, and take it."""
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        if len(self._items) < max_items:
+            await asyncio.sleep(wait)
+
+        lines = []
+        chars = 0
+        while self._items and len(lines) < max_items:
+            line, created = self._items[0]
+            if lines and chars + len(line) + 1 > max_chars:
+                break
+            self._items.popleft()
+            lines.append(line[:max_chars])
+            chars += len(line) + 1
+            self.last_lag = max(0.0, time.time() - created)
+            self.max_lag = max(self.max_lag, self.last_lag)
+        self.sent += len(lines)
+        self.digests += 1
+        return lines
+
+    def stats(self) -> str:
+        return (
+            f"{len(self)}/{self._items.maxlen} queued, {self.offered} offered, "
+            f"{self.duplicates} duplicates, {self.dropped} dropped, "
+            f"{self.sent} sent in {self.digests} digests, "
+            f"lag {self.last_lag:.1f}s (max {self.max_lag:.1f}s)"
+        )
@@ -0,0 +1,142 @@
+import asyncio
+import random
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import dice
+import numpy as np
+
+MAX_EXPRESSION_LENGTH: int = 120
+MAX_NESTING: int = 6
+MAX_DICE_TERMS: int = 20
+# Dice rolled by any one element, enforced by the dice library itself.
+MAX_DICE: int = 100_000
+# Expressions estimated to roll at most this many dice are evaluated in the event loop.
+INLINE_COST: int = 1_000
+ROLL_WORKERS: int = 2
+ROLL_TIMEOUT: float = 2.0
+# Totals numpy can sum without wrapping; bigger rolls go through the dice library.
+MAX_FAST_TOTAL: int = np.iinfo(np.int64).max
+
+SIMPLE_ROLL: re.Pattern = re.compile(r"(\d*)d(\d+)(?:([+-])(\d+))?", re.IGNORECASE)
+DICE_TERM: re.Pattern = re.compile(r"(\d*|\))\s*[dwu]\s*(?:\d+|%|f)?", re.IGNORECASE)
+# Explode, reroll and again can roll each die several times over.
+REPEATS: re.Pattern = re.compile(r"[xra]", re.IGNORECASE)
+
+
+class RollRejected(Exception):
+    """Raised with a message for the user when a roll is invalid or too expensive."""
+
+
+def estimate_cost(expression: str) -> int:
+    """Return roughly how many dice expression rolls, rejecting ones over the limits."""
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise RollRejected(f"too long (max {MAX_EXPRESSION_LENGTH} characters)")
+
+    depth = 0
+    for char in expression:
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        if depth > MAX_NESTING:
+            raise RollRejected(f"nested too deeply (max {MAX_NESTING} levels)")
+
+    terms = DICE_TERM.findall(expression)
+    if len(terms) > MAX_DICE_TERMS:
+        raise RollRejected(f"too many dice terms (max {MAX_DICE_TERMS})")
+
+    cost = 0
+    for amount in terms:
+        # A computed amount could be anything up to the per-element cap.
+        dice_count = MAX_DICE if amount == ")" else int(amount or 1)
+        if dice_count > MAX_DICE:
+            raise RollRejected(f"too many dice (max {MAX_DICE})")
+        cost += dice_count
+    if REPEATS.search(expression):
+        cost *= 8
+    return cost
+
+
+def fast_roll(expression: str) -> int | None:
+    """Roll a plain NdM+K expression without the parser, or return None."""
+    match = SIMPLE_ROLL.fullmatch(expression.replace(" ", ""))
+    if match is None:
+        return None
+    amount, sides, sign, modifier = match.groups()
+    amount, sides = int(amount or 1), int(sides)
+    if amount > MAX_DICE:
+        raise RollRejected(f"too many dice (max {MAX_DICE})")
+    if sides < 1:
+        return None
+
+    if amount <= INLINE_COST:
+        total = sum(random.randint(1, sides) for _ in range(amount))
+    elif amount * sides > MAX_FAST_TOTAL:
+        return None
+    else:
+        total = int(
+            np.random.default_rng().integers(1, sides, amount, endpoint=True).sum()
+        )
+    if modifier:
+        total += int(modifier) if sign == "+" else -int(modifier)
+    return total
+
+
+def evaluate(expression: str, max_dice: int = MAX_DICE) -> str:
+    """Roll expression with the dice library and return the result as text.
+
+    Runs in worker processes, so failures come back as RollRejected.
+    """
+    try:
+        result = dice.roll(expression, max_dice=max_dice)
+    except dice.DiceBaseException as e:
+        raise RollRejected(str(e).splitlines()[0]) from None
+    except (ValueError, ZeroDivisionError, RecursionError) as e:
+        raise RollRejected(str(e)) from None
+    if type(result) == dice.elements.Roll:
+        result = sum(result)
+    return str(result)
+
+
+class RollSandbox:
+    """Evaluates rolls, sending expensive ones to a process pool under a timeout."""
+
+    def __init__(self, workers: int = ROLL_WORKERS, timeout: float = ROLL_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._pool: ProcessPoolExecutor | None = None
+
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def kill(self):
+        """Stop the pool, terminating any roll that is still running."""
+        if self._pool is None:
+            return
+        # The executor has no public way to stop a running task.
+        for process in list(self._pool._processes.values()):
+            process.terminate()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+
+    async def roll(self, expression: str) -> str:
+        total = fast_roll(expression)
+        if total is not None:
+            return str(total)
+
+        if estimate_cost(expression) <= INLINE_COST:
+            return evaluate(expression)
+
+        future = asyncio.get_running_loop().run_in_executor(
+            self.pool(), evaluate, expression
+        )
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            print(f"Roll timed out: {expression}")
+            self.kill()
+            raise RollRejected(f"took longer than {self.timeout:g}s") from None
+        except BrokenProcessPool:
+            self.kill()
+            raise RollRejected("the roller crashed") from None
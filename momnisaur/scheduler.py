@@ -0,0 +1,310 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+
+# Priority lanes, most urgent first.
+INTERACTIVE: int = 0
+BACKGROUND: int = 1
+BULK: int = 2
+LANES: dict[int, str] = {
+    INTERACTIVE: "interactive",
+    BACKGROUND: "background",
+    BULK: "bulk",
+}
+
+# Names of the openai.error exceptions worth retrying.
+RETRYABLE_ERRORS: tuple[str, ...] = (
+    "RateLimitError",
+    "APIError",
+    "APIConnectionError",
+    "ServiceUnavailableError",
+    "Timeout",
+)
+
+
+def estimate_tokens(kwargs: dict, completion_tokens: int = 256) -> int:
+    """Roughly estimate the tokens a request spends, at four characters per token."""
+    if "messages" in kwargs:
+        prompt = sum(len(m["content"]) for m in kwargs["messages"]) // 4
+        return prompt + kwargs.get("max_tokens", completion_tokens)
+    inputs = kwargs.get("input", "")
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    return sum(len(text) for text in inputs) // 4 + 1
+
+
+class TokenBucket:
+    """Refills rate units per minute, holding at most one minute's worth."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.level = rate
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.rate, self.level + (now - self.updated) * self.rate / 60)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until amount can be taken; more than rate waits for a full bucket."""
+        self.refill()
+        amount = min(amount, self.rate)
+        return max(0.0, (amount - self.level) * 60 / self.rate)
+
+    def take(self, amount: float):
+        self.refill()
+        self.level -= min(amount, self.rate)
+
+    def drain(self):
+        self.refill()
+        self.level = min(self.level, 0)
+
+
+class ModelBudget:
+    """Per-minute request and token budgets of one model, and its rate limit pause."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+
+    def delay(self, tokens: int) -> float:
+        return max(
+            self.paused_until - time.monotonic(),
+            self.requests.delay(1),
+            self.tokens.delay(tokens),
+        )
+
+    def take(self, tokens: int):
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+    def pause(self, seconds: float):
+        """Hold back requests and empty the budgets after a rate limit response."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.requests.drain()
+        self.tokens.drain()
+
+
+class LaneStats:
+    def __init__(self):
+        self.waiting = 0
+        self.started = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class OpenAIScheduler:
+    """Runs OpenAI requests under a concurrency cap and per-model rate budgets.
+
+    limits maps a model to its (requests, tokens) per minute; other models get
+    default_limits. Waiting requests start in priority order, then arrival order, except
+    that a request whose model is out of budget does not hold back other models.
+    Retryable errors are retried with jittered exponential backoff, and a rate limit
+    response pauses the model that reported it briefly.
+    """
+
+    def __init__(
+        self,
+        api_key: str | None = None,
+        organization: str | None = None,
+        concurrency: int = 8,
+        limits: dict[str, tuple[float, float]] | None = None,
+        default_limits: tuple[float, float] = (3500, 90_000),
+        retries: int = 5,
+        backoff: float = 1.0,
+    ):
+        self.api_key = api_key
+        self.organization = organization
+        self._openai = None
+        self._retryable: tuple[type[Exception], ...] = ()
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.default_limits = default_limits
+        self.budgets: dict[str, ModelBudget] = {
+            model: ModelBudget(*model_limits)
+            for model, model_limits in (limits or {}).items()
+        }
+        self.active = 0
+        self.lanes: dict[int, LaneStats] = {lane: LaneStats() for lane in LANES}
+        self._waiting: list[tuple[int, int, str, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+
+    def client(self):
+        """Return the openai module, importing and configuring it on first use.
+
+        openai is slow to import, so the bot can connect before anything needs it.
+        """
+        if self._openai is None:
+            import openai
+
+            openai.api_key = self.api_key
+            openai.organization = self.organization
+            self._retryable = tuple(
+                getattr(openai.error, name) for name in RETRYABLE_ERRORS
+            )
+            self._openai = openai
+        return self._openai
+
+    @property
+    def errors(self):
+        """The openai.error module, for catching errors raised by requests."""
+        return self.client().error
+
+    async def chat(self, priority: int = INTERACTIVE, **kwargs):
+        return await self.request(
+            self.client().ChatCompletion.acreate, kwargs, priority
+        )
+
+    async def embed(self, priority: int = BULK, **kwargs):
+        return await self.request(self.client().Embedding.acreate, kwargs, priority)
+
+    async def stream_chat(self, priority: int = INTERACTIVE, **kwargs):
+        """Yield the content deltas of a streamed chat completion.
+
+        The request keeps its slot until the stream ends, and is only retried if it
+        fails before the first chunk arrives.
+        """
+        model = kwargs.get("model", "")
+        tokens = estimate_tokens(kwargs)
+        lane = self.lanes[priority]
+        for attempt in range(self.retries):
+            await self.acquire(priority, model, tokens)
+            started = False
+            try:
+                async for chunk in await self.client().ChatCompletion.acreate(
+                    stream=True, **kwargs
+                ):
+                    started = True
+                    yield chunk["choices"][0]["delta"].get("content", "")
+                return
+            except self._retryable as e:
+                if started or attempt == self.retries - 1:
+                    lane.failures += 1
+                    raise
+                error = e
+            finally:
+                self.release()
+
+            lane.retries += 1
+            delay = self.backoff * 2**attempt * (1 + random.random())
+            print(
+                f"Retrying {LANES[priority]} OpenAI stream in {delay:.1f}s: {error!r}"
+            )
+            if isinstance(error, self.errors.RateLimitError):
+                self.budget(model).pause(delay)
+            await asyncio.sleep(delay)
+
+    async def request(self, fn, kwargs: dict, priority: int):
+        model = kwargs.get("model", "")
+        tokens = estimate_tokens(kwargs)
+        lane = self.lanes[priority]
+        for attempt in range(self.retries):
+            await self.acquire(priority, model, tokens)
+            try:
+                return await fn(**kwargs)
+            except self._retryable as e:
+                if attempt == self.retries - 1:
+                    lane.failures += 1
+                    raise
+                error = e
+            finally:
+                self.release()
+
+            lane.retries += 1
+            delay = self.backoff * 2**attempt * (1 + random.random())
+            print(
+                f"Retrying {LANES[priority]} OpenAI request in {delay:.1f}s: {error!r}"
+            )
+            if isinstance(error, self.errors.RateLimitError):
+                self.budget(model).pause(delay)
+            await asyncio.sleep(delay)
+
+    def budget(self, model: str) -> ModelBudget:
+        if model not in self.budgets:
+            self.budgets[model] = ModelBudget(*self.default_limits)
+        return self.budgets[model]
+
+    async def acquire(self, priority: int, model: str, tokens: int):
+        lane = self.lanes[priority]
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self._waiting, (priority, next(self._counter), model, tokens, future)
+        )
+        lane.waiting += 1
+        start = time.monotonic()
+        try:
+            self.dispatch()
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            lane.waiting -= 1
+        waited = time.monotonic() - start
+        lane.started += 1
+        lane.total_wait += waited
+        lane.max_wait = max(lane.max_wait, waited)
+
+    def release(self):
+        self.active -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        # Once a model's first waiting request is out of budget, its later ones wait
+        # too.
+        blocked: set[str] = set()
+        wake = None
+        for _, _, model, tokens, future in sorted(self._waiting):
+            if self.active >= self.concurrency:
+                break
+            if future.done() or model in blocked:
+                continue
+            budget = self.budget(model)
+            delay = budget.delay(tokens)
+            if delay > 0:
+                blocked.add(model)
+                wake = delay if wake is None else min(wake, delay)
+                continue
+            budget.take(tokens)
+            self.active += 1
+            future.set_result(None)
+        self._waiting = [entry for entry in self._waiting if not entry[-1].done()]
+        heapq.heapify(self._waiting)
+        if wake is not None:
+            self.wake_in(wake)
+
+    def wake_in(self, delay: float):
+        if self._timer is not None and not self._timer.cancelled():
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self.dispatch)
+
+    def queue_depth(self) -> int:
+        return sum(lane.waiting for lane in self.lanes.values())
+
+    def stats(self) -> str:
+        lines = [
+            f"{self.active}/{self.concurrency} active, {self.queue_depth()} queued"
+        ]
+        for priority, lane in self.lanes.items():
+            average = lane.total_wait / lane.started if lane.started else 0
+            lines.append(
+                f"{LANES[priority]}: {lane.waiting} queued, {lane.started} started, "
+                f"{lane.retries} retries, {lane.failures} failed, "
+                f"wait avg {average:.2f}s max {lane.max_wait:.2f}s"
+            )
+        for model, budget in self.budgets.items():
+            budget.tokens.refill()
+            lines.append(
+                f"{model}: {budget.tokens.level:,.0f}/{budget.tokens.rate:,.0f}"
+                " tokens left"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,34 @@
+import contextlib
+import os
+import zipfile
+
+import numpy as np
+
+
+@contextlib.contextmanager
+def atomic_write(path: str, mode: str = "w"):
+    """Open a temporary file in place of path, replacing path once it is written.
+
+    Readers see the old file or the new one, never a partial write.
+    """
+    temporary = f"{path}.tmp"
+    try:
+        with open(temporary, mode, encoding=None if "b" in mode else "utf8") as file:
+            yield file
+        os.replace(temporary, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temporary)
+        raise
+
+
+def load_npz(path: str, *keys: str) -> dict[str, np.ndarray] | None:
+    """Return the named arrays saved at path, or None if it is missing or unreadable."""
+    if not os.path.isfile(path):
+        return None
+    try:
+        with np.load(path) as saved:
+            return {key: saved[key] for key in keys}
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+        print(f"Ignoring unreadable {path}: {e!r}")
+        return None